@@ -1,34 +1,71 @@
 import logging
 import warnings
-from os import environ
+from os import environ, getpid
+from socket import gethostname
 from sys import stdout
 
-from motor.motor_asyncio import AsyncIOMotorClient
-from telegram.warnings import PTBUserWarning
-from toml import loads
+from app.cache import TTLCache
+from app.coalescer import Coalescer
+from app.context import AppContext
+from app.processor import OrderedProcessor
+from app.scheduler import Scheduler
 
-from app.types import DialogManager
+""" Workers: several instances of the bot can share the same database """
+workers = int(environ.get("WORKERS", "1"))
+worker_index = int(environ.get("WORKER_INDEX", "0"))
+instance_id = f"{gethostname()}:{getpid()}"
 
-""" Logging """
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-    stream=stdout,
+""" Database, strings and conversations, set up on first use (see AppContext) """
+ctx = AppContext(workers, instance_id)
+pending_ttl = int(environ.get("PENDING_TTL_DAYS", "30")) * 86400
+clean_up_db = True if environ.get("CLEAN_UP_DB", False) == "true" else False
+log_retention = environ.get("LOG_RETENTION", "")
+notify_idle_dialogs = environ.get("NOTIFY_IDLE_DIALOGS", "true") == "true"
+
+""" Read-through cache of chats settings, invalidated on writes """
+# Invalidations only reach the worker making the change: no caching with several workers
+settings_cache = TTLCache(
+    max_size=int(environ.get("SETTINGS_CACHE_SIZE", "1000")) if workers == 1 else 0,
+    ttl=int(environ.get("SETTINGS_CACHE_TTL", "300")),
 )
-warnings.filterwarnings("error", category=PTBUserWarning)
 
-""" Database """
-client = AsyncIOMotorClient(environ["MONGO_CONN_STRING"])
-db = client["alert-me"]
-chats = db["chats"]
-logs = db["logs"]
-clean_up_db = True if environ.get("CLEAN_UP_DB", False) == "true" else False
+""" Chats administrators cache, invalidated on chat member updates """
+admins_cache = TTLCache(
+    max_size=int(environ.get("ADMINS_CACHE_SIZE", "1000")) if workers == 1 else 0,
+    ttl=int(environ.get("ADMINS_CACHE_TTL", "600")),
+)
+
+""" Pages of the /status messages, for their Previous / Next buttons to page through """
+status_pages = TTLCache(max_size=100, ttl=3600)
+
+""" Updates processed concurrently, in order per chat and per user """
+processor = OrderedProcessor(limit=int(environ.get("CONCURRENT_UPDATES", "32")))
+
+""" Update ids processed lately: updates delivered again by Telegram are dropped """
+recent_updates = TTLCache(
+    max_size=int(environ.get("RECENT_UPDATES_SIZE", "10000")),
+    ttl=int(environ.get("RECENT_UPDATES_TTL", "86400")),
+)
+
+""" Deadlines of join requests follow-ups """
+scheduler = Scheduler()
+
+""" Manual mode: join requests arriving in bursts are notified to admins as digests """
+notifications = Coalescer(window=float(environ.get("DIGEST_WINDOW", "5")))
+
+""" Metrics """
+metrics_port = environ.get("METRICS_PORT")
+
+
+""" Logging, when running the bot """
+
 
-""" Setup strings """
-strings = ""
-with open("strings.toml", "r") as f:
-    r = f.read()
-    strings = loads(r)
+def setup_logging():
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+        stream=stdout,
+    )
+    from telegram.warnings import PTBUserWarning
 
-""" Conversation manager handling 1-1 conversations """
-dialog_manager = DialogManager()
+    warnings.filterwarnings("error", category=PTBUserWarning)
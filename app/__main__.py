@@ -1,41 +1,79 @@
+from asyncio import Event, get_running_loop, run
+from functools import partial
 from os import environ
-from sys import argv
+from pathlib import Path
+from signal import SIGINT, SIGTERM, signal
+from subprocess import Popen
+from sys import argv, executable
 
-from telegram import Message
+from telegram import Message, Update
 from telegram.ext import (
     Application,
     CallbackQueryHandler,
     ChatJoinRequestHandler,
+    ChatMemberHandler,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 from telegram.ext.filters import MessageFilter
 
-from app import dialog_manager
+from app import (
+    ctx,
+    metrics_port,
+    notifications,
+    processor,
+    scheduler,
+    setup_logging,
+    worker_index,
+    workers,
+)
+from app.db import (
+    apply_retention,
+    ensure_indexes,
+    keep_sweep_lease,
+    process_due,
+    release_sweep_lease,
+    schedule_pending,
+)
 from app.handlers import (
     admin_op,
     answering_help,
+    dropping_duplicates,
     expected_dialog,
+    expire_idle_dialogs,
     getting_status,
     has_joined,
     processing_cbq,
     replying_to_bot,
     resetting,
     setting_bot,
+    tracking_admins,
     wants_to_join,
 )
+from app.ingress import Ingress
+from app.metrics import Gauge, serve_metrics, timed
+from app.processor import OrderedApplication
+from app.ratelimiter import OutboundLimiter
 
 
 class Dialog(MessageFilter):
     """Custom filter"""
 
     def filter(self, message: Message) -> bool:
-        return hasattr(message, "text") and message.from_user.id in dialog_manager
+        return hasattr(message, "text") and message.from_user.id in ctx.dialog_manager
 
 
 def registerHandlers(app: Application):
-    expectedDialogHandler = MessageHandler(Dialog(), expected_dialog)
+    # Shared dialogs may have been started by another worker: looking them up in the store
+    # for any message that could be part of a conversation
+    dialogFilter = (
+        filters.TEXT & (filters.ChatType.PRIVATE | filters.REPLY)
+        if ctx.dialog_manager.shared
+        else Dialog()
+    )
+    expectedDialogHandler = MessageHandler(dialogFilter, expected_dialog)
     joinReqHandler = ChatJoinRequestHandler(wants_to_join)
     acceptReject = CallbackQueryHandler(processing_cbq)
     answerHelp = CommandHandler(["help", "start"], answering_help)
@@ -45,24 +83,182 @@ def registerHandlers(app: Application):
     newMember = MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, has_joined)
     replyToBot = MessageHandler(filters.REPLY, replying_to_bot)
     adminOp = CommandHandler("admin", admin_op)
+    trackAdmins = ChatMemberHandler(tracking_admins, ChatMemberHandler.ANY_CHAT_MEMBER)
 
-    app.add_handlers(
-        [
-            expectedDialogHandler,
-            adminOp,
-            acceptReject,
-            setBot,
-            reset,
-            status,
-            newMember,
-            joinReqHandler,
-            answerHelp,
-            replyToBot,
-        ]
-    )
+    handlers = [
+        adminOp,
+        acceptReject,
+        setBot,
+        reset,
+        status,
+        newMember,
+        joinReqHandler,
+        answerHelp,
+        replyToBot,
+        trackAdmins,
+    ]
+    for handler in [expectedDialogHandler, *handlers]:
+        handler.callback = timed(handler.callback)
+
+    # Runs before anything else, and stops updates already processed
+    app.add_handler(TypeHandler(Update, dropping_duplicates), group=-2)
+    # Then, stops the update from reaching the other handlers when it was part of a dialog
+    app.add_handler(expectedDialogHandler, group=-1)
+    app.add_handlers(handlers)
     print("Handlers successfully registered")
 
 
+def watch_gauges(app: Application):
+    # Read at scrape time
+    Gauge(
+        "ringo_dialogs_in_memory",
+        "Conversations held by the DialogManager",
+        read=lambda: len(ctx.dialog_manager),
+    )
+    Gauge(
+        "ringo_dialogs_timing_out",
+        "Conversations, in memory or in the store, with an idle timeout pending",
+        read=lambda: len(ctx.dialog_manager.wheel),
+    )
+    Gauge(
+        "ringo_log_writer_depth",
+        "Log writes waiting to be flushed",
+        read=lambda: ctx.log_writer.depth,
+    )
+    Gauge(
+        "ringo_scheduled_deadlines",
+        "Deadlines held by the scheduler",
+        read=lambda: len(scheduler),
+    )
+    Gauge(
+        "ringo_updates_running",
+        "Updates being processed",
+        read=lambda: processor.running,
+    )
+    Gauge(
+        "ringo_updates_waiting",
+        "Updates waiting for a previous one of their chat or user, or for a slot",
+        read=lambda: processor.waiting,
+    )
+    if ingress := app.bot_data.get("ingress"):
+        Gauge(
+            "ringo_ingress_queue_depth",
+            "Updates accepted by the ingress, waiting for a consumer",
+            read=lambda: len(ingress),
+        )
+
+
+async def on_startup(app: Application):
+    await ensure_indexes()
+    print("Database indexes ensured")
+    retention = await apply_retention()
+    print(f"Logs retention (days): {retention or 'unlimited'}")
+    ctx.log_writer.start()
+    pending = await schedule_pending()
+    scheduler.start(partial(process_due, app.bot))
+    print(f"Scheduler started with {pending} pending join requests")
+    restored = await ctx.dialog_manager.restore()
+    print(f"DialogManager: {restored} conversations found in the store")
+    ctx.dialog_manager.start(partial(expire_idle_dialogs, app.bot))
+    app.bot_data["sweep_lease"] = keep_sweep_lease()
+    if metrics_port:
+        watch_gauges(app)
+        # Next to the webhook, one port per worker
+        serve_metrics(int(metrics_port) + worker_index)
+        print(f"Serving metrics on port {int(metrics_port) + worker_index}")
+
+
+async def on_stop(app: Application):
+    # Before the bot is shut down: buffered digests still have to be sent
+    await notifications.drain()
+
+
+async def on_shutdown(app: Application):
+    if task := app.bot_data.pop("sweep_lease", None):
+        task.cancel()
+        await release_sweep_lease()
+    await scheduler.stop()
+    await ctx.dialog_manager.stop()
+    await ctx.log_writer.stop()
+
+
+async def run_ingress(
+    app: Application,
+    ingress: Ingress,
+    port: int,
+    url_path: str,
+    webhook_url: str,
+    cert: str | None = None,
+    key: str | None = None,
+):
+    # The lifecycle of `run_webhook`, the ingress standing in for PTB's webhook server
+    stopping = Event()
+    for sig in (SIGINT, SIGTERM):
+        get_running_loop().add_signal_handler(sig, stopping.set)
+
+    app.bot_data["ingress"] = ingress
+    await app.initialize()
+    await on_startup(app)
+    await app.start()
+    ingress.start(
+        port, url_path, ssl_options={"certfile": cert, "keyfile": key} if cert else None
+    )
+    await app.bot.set_webhook(
+        webhook_url,
+        certificate=Path(cert) if cert else None,
+        allowed_updates=Update.ALL_TYPES,
+        secret_token=ingress.secret_token,
+    )
+    print(
+        f"Ingress listening on port {port}, up to {ingress.max_pending} updates pending"
+    )
+
+    await stopping.wait()
+    await ingress.stop()
+    await app.stop()
+    await on_stop(app)
+    await app.shutdown()
+    await on_shutdown(app)
+
+
+def build_app(token: str) -> Application:
+    builder = (
+        Application.builder()
+        .application_class(OrderedApplication, {"processor": processor})
+        .token(token)
+        .rate_limiter(OutboundLimiter())
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if BOT_API_URL := environ.get("BOT_API_URL"):
+        # A local Bot API server, or the fake one of the load generator
+        builder = builder.base_url(f"{BOT_API_URL}/bot")
+    return builder.build()
+
+
+def run_workers(n: int, port: int):
+    # Each worker is a full instance of the bot listening on its own port, from `port` to `port + n - 1`.
+    # A load balancer is expected in front of them.
+    processes = [
+        Popen(
+            [executable, "-m", "app", *argv[1:]],
+            env=environ | {"WORKER_INDEX": str(i), "PORT": str(port + i)},
+        )
+        for i in range(n)
+    ]
+    signal(SIGTERM, lambda *_: [p.terminate() for p in processes])
+    print(f"Started {n} workers on ports {port} to {port + n - 1}")
+
+    try:
+        for p in processes:
+            p.wait()
+    except KeyboardInterrupt:
+        for p in processes:
+            p.terminate()
+            p.wait()
+
+
 if __name__ == "__main__":
     """
     Run the program with `--polling` to run as a long-polling application
@@ -76,17 +272,53 @@ if __name__ == "__main__":
     HOST = environ["HOST"]
     ENDPOINT = environ["ENDPOINT"]
     PORT = int(environ.get("PORT", "8443"))
+    # Sent back by Telegram with every update, when set
+    WEBHOOK_SECRET = environ.get("WEBHOOK_SECRET") or None
 
     private_key_path = "./private.key"
     certificate_path = "./cert.pem"
+    polling = "polling" in argv[1] if len(argv) >= 2 else False
+
+    if workers > 1 and "WORKER_INDEX" not in environ:
+        if polling:
+            raise SystemExit("Several workers can only be run in webhook mode.")
+        run_workers(workers, PORT)
+        raise SystemExit(0)
 
+    setup_logging()
     uvloop.install()
-    app = Application.builder().token(TOKEN).build()
+    app = build_app(TOKEN)
     registerHandlers(app)
 
-    if "polling" in argv[1] if len(argv) >= 2 else False:
+    if polling:
         print("Running in long-poll mode. Good luck.")
-        app.run_polling(drop_pending_updates=True)
+        app.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+
+    elif environ.get("INGRESS") == "true":
+        ssl = path.exists(certificate_path) and path.exists(private_key_path)
+        ingress = Ingress(
+            app,
+            processor,
+            max_size=int(environ.get("INGRESS_QUEUE_SIZE", "10000")),
+            max_pending=int(environ.get("INGRESS_PENDING", "256")),
+            secret_token=WEBHOOK_SECRET,
+        )
+        print(
+            f"Starting ingress & webhook ({ENDPOINT}/bot<TOKEN>) on port {PORT} {'with' if ssl else '*without*'} an SSL certificate. Updates are acknowledged as soon as queued."
+        )
+        run(
+            run_ingress(
+                app,
+                ingress,
+                PORT,
+                f"{ENDPOINT}/bot{TOKEN}",
+                f"{HOST}/{ENDPOINT}/bot{TOKEN}"
+                if ssl
+                else f"{HOST}{ENDPOINT}/bot{TOKEN}",
+                cert=certificate_path[2:] if ssl else None,
+                key=private_key_path[2:] if ssl else None,
+            )
+        )
 
     elif path.exists(certificate_path) and path.exists(private_key_path):
         print(
@@ -99,6 +331,8 @@ if __name__ == "__main__":
             webhook_url=f"{HOST}/{ENDPOINT}/bot{TOKEN}",
             key=private_key_path[2:],
             cert=certificate_path[2:],
+            allowed_updates=Update.ALL_TYPES,
+            secret_token=WEBHOOK_SECRET,
         )
     else:
         print(
@@ -109,4 +343,6 @@ if __name__ == "__main__":
             port=PORT,
             url_path=f"{ENDPOINT}/bot{TOKEN}",
             webhook_url=f"{HOST}{ENDPOINT}/bot{TOKEN}",
+            allowed_updates=Update.ALL_TYPES,
+            secret_token=WEBHOOK_SECRET,
         )
@@ -0,0 +1,48 @@
+from time import monotonic
+from typing import Any, Hashable, OrderedDict
+
+
+class TTLCache(OrderedDict):
+    """
+    Bounded in-process cache. Entries expire `ttl` seconds after being stored
+    and the least recently used entries are evicted first.
+    """
+
+    max_size: int
+    ttl: float
+    hits: int
+    misses: int
+
+    def __init__(self, max_size=1000, ttl: float = 300):
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def fetch(self, key: Hashable) -> Any | None:
+        if entry := super().get(key):
+            value, expires_at = entry
+            if expires_at > monotonic():
+                self.hits += 1
+                self.move_to_end(key)
+                return value
+            self.__delitem__(key)
+
+        self.misses += 1
+
+    def put(self, key: Hashable, value: Any):
+        super().__setitem__(key, (value, monotonic() + self.ttl))
+        self.move_to_end(key)
+
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self.pop(key, None)
+
+    @property
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups if lookups else 0
+        return f"{len(self)} entries, {self.hits} hits, {self.misses} misses ({ratio:.0%} hit ratio)"
@@ -0,0 +1,90 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from struct import error as StructError
+from struct import pack, unpack
+from typing import Any, NamedTuple
+
+""" Callback data of inline buttons, versioned. Telegram caps it at 64 bytes. """
+
+VERSION = "1"
+MAX_BYTES = 64
+
+
+class Callback(NamedTuple):
+    operation: str
+    args: tuple
+    # Only for display, truncated to fit
+    text: str = ""
+
+
+# Operation: (code, arguments layout). Digests ids are 12 bytes ObjectIds, passed around as hex strings.
+LAYOUTS: dict[str, tuple[int, str]] = {
+    "self-confirm": (1, "qq"),  # user_id, chat_id
+    "accept": (2, "qq"),  # chat_id, user_id
+    "reject": (3, "qq"),  # chat_id, user_id
+    "digest-page": (4, "12sH"),  # digest_id, page
+    "digest-accept": (5, "12sq"),  # digest_id, user_id
+    "digest-reject": (6, "12sq"),  # digest_id, user_id
+    "digest-accept-all": (7, "12s"),  # digest_id
+    "digest-reject-all": (8, "12s"),  # digest_id
+    "status-page": (9, "qH"),  # chat_id, page
+}
+OPERATIONS = {
+    code: (operation, layout) for operation, (code, layout) in LAYOUTS.items()
+}
+
+
+def encode(operation: str, *args: Any, text: str = "") -> str:
+    code, layout = LAYOUTS[operation]
+    packed = pack(
+        ">B" + layout,
+        code,
+        *[bytes.fromhex(arg) if isinstance(arg, str) else arg for arg in args],
+    )
+    token = VERSION + urlsafe_b64encode(packed).rstrip(b"=").decode()
+    if not text:
+        return token
+
+    # Cutting on a character boundary
+    room = MAX_BYTES - len(token) - 1
+    return f"{token}.{text.encode()[:room].decode(errors='ignore')}"
+
+
+def decode(data: str) -> Callback | None:
+    try:
+        if "§" in data:
+            return decode_legacy(data)
+        match data[:1]:
+            case "1":
+                return decode_v1(data[1:])
+    except (ValueError, KeyError, IndexError, StructError, Base64Error):
+        return None
+
+
+def decode_v1(data: str) -> Callback:
+    token, _, text = data.partition(".")
+    raw = urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    operation, layout = OPERATIONS[raw[0]]
+    args = unpack(">" + layout, raw[1:])
+    return Callback(
+        operation,
+        tuple(arg.hex() if isinstance(arg, bytes) else arg for arg in args),
+        text,
+    )
+
+
+def decode_legacy(data: str) -> Callback:
+    # Buttons sent before tokens were versioned: fields joined by '§'
+    operation, *fields = data.split("§")
+    match operation:
+        case "self-confirm":
+            from_user_chat_id, target_chat_id = fields[0], fields[1]
+            return Callback(operation, (int(from_user_chat_id), int(target_chat_id)))
+        case "accept" | "reject":
+            chat_id, user_id, user_name = fields[0], fields[2], fields[3]
+            return Callback(operation, (int(chat_id), int(user_id)), user_name)
+        case "digest-page" | "digest-accept" | "digest-reject":
+            return Callback(operation, (fields[0], int(fields[1])))
+        case "digest-accept-all" | "digest-reject-all":
+            return Callback(operation, (fields[0],))
+    raise ValueError(f"Unknown operation {operation}")
@@ -0,0 +1,67 @@
+from asyncio import Task, create_task, sleep
+from time import monotonic
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+from app.cache import TTLCache
+
+T = TypeVar("T")
+Flush = Callable[[Hashable, list[T]], Awaitable[None]]
+
+
+class Coalescer(Generic[T]):
+    """
+    Batches items by key. An item for a key that was not flushed within the last `window` seconds
+    is flushed right away, on its own; the following ones are held until the window closes and flushed together.
+    """
+
+    window: float
+    buffers: dict[Hashable, list[T]]
+    flushes: dict[Hashable, Flush]
+    # Keys flushed within the last `window` seconds, forgotten afterwards
+    flushed_at: TTLCache
+    tasks: dict[Hashable, Task]
+
+    def __init__(self, window: float = 5, max_keys: int = 10_000):
+        self.window = window
+        self.buffers = {}
+        self.flushes = {}
+        self.flushed_at = TTLCache(max_size=max_keys, ttl=window)
+        self.tasks = {}
+
+    async def submit(self, key: Hashable, item: T, flush: Flush):
+        if key in self.buffers:
+            self.buffers[key].append(item)
+            return
+
+        last = self.flushed_at.fetch(key)
+        if last is None:
+            await self._run(key, [item], flush)
+            return
+
+        self.buffers[key] = [item]
+        self.flushes[key] = flush
+        delay = last + self.window - monotonic()
+        self.tasks[key] = create_task(self._flush_later(key, delay))
+
+    async def _flush_later(self, key: Hashable, delay: float):
+        await sleep(delay)
+        self.tasks.pop(key, None)
+        await self._flush(key)
+
+    async def _flush(self, key: Hashable):
+        items, flush = self.buffers.pop(key), self.flushes.pop(key)
+        await self._run(key, items, flush)
+
+    async def _run(self, key: Hashable, items: list[T], flush: Flush):
+        self.flushed_at.put(key, monotonic())
+        try:
+            await flush(key, items)
+        except Exception as error:
+            print(f"Coalescer: failed to flush {len(items)} items for {key}: {error}")
+
+    async def drain(self):
+        # Flushes everything still buffered, on shutdown
+        for key, task in list(self.tasks.items()):
+            task.cancel()
+            del self.tasks[key]
+            await self._flush(key)
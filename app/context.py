@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+from datetime import timedelta
+from functools import cached_property
+from os import environ
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from motor.motor_asyncio import (
+        AsyncIOMotorClient,
+        AsyncIOMotorCollection,
+        AsyncIOMotorDatabase,
+    )
+
+    from app.types import DialogManager
+    from app.writer import LogWriter
+
+
+class AppContext:
+    """
+    Everything needing the environment, the database or files on disk, built on first use rather than on import:
+    modules only importing types or helpers need neither a connection string nor `strings.toml`.
+    """
+
+    workers: int
+    instance_id: str
+
+    def __init__(self, workers: int, instance_id: str):
+        self.workers = workers
+        self.instance_id = instance_id
+
+    """ Database """
+
+    @cached_property
+    def client(self) -> AsyncIOMotorClient:
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        from app.metrics import MongoTimings
+
+        return AsyncIOMotorClient(
+            environ["MONGO_CONN_STRING"], event_listeners=[MongoTimings()]
+        )
+
+    @cached_property
+    def db(self) -> AsyncIOMotorDatabase:
+        return self.client["alert-me"]
+
+    @cached_property
+    def chats(self) -> AsyncIOMotorCollection:
+        return self.db["chats"]
+
+    @cached_property
+    def logs(self) -> AsyncIOMotorCollection:
+        return self.db["logs"]
+
+    @cached_property
+    def pending_requests(self) -> AsyncIOMotorCollection:
+        return self.db["pending"]
+
+    @cached_property
+    def digests(self) -> AsyncIOMotorCollection:
+        return self.db["digests"]
+
+    @cached_property
+    def leases(self) -> AsyncIOMotorCollection:
+        return self.db["leases"]
+
+    @cached_property
+    def answers(self) -> AsyncIOMotorCollection:
+        return self.db["answers"]
+
+    @cached_property
+    def updates(self) -> AsyncIOMotorCollection:
+        return self.db["updates"]
+
+    @cached_property
+    def log_writer(self) -> LogWriter:
+        from app.writer import LogWriter
+
+        return LogWriter(self.logs)
+
+    """ Setup strings """
+
+    @cached_property
+    def strings(self) -> dict[str, Any]:
+        from toml import loads
+
+        with open("strings.toml", "r") as f:
+            return loads(f.read())
+
+    """ Conversation manager handling 1-1 conversations """
+
+    @cached_property
+    def dialog_manager(self) -> DialogManager:
+        from app.lease import Lease, holding
+        from app.store import MongoDialogStore, SQLiteDialogStore
+        from app.types import DialogManager
+        from app.wheel import TimingWheel
+
+        dialog_store_path = environ.get("DIALOG_STORE_PATH")
+        return DialogManager(
+            max_size=int(environ.get("DIALOGS_IN_MEMORY", "1000")),
+            store=SQLiteDialogStore(dialog_store_path)
+            if dialog_store_path
+            else MongoDialogStore(self.db["dialogs"]),
+            shared=self.workers > 1,
+            locks=lambda user_id: holding(
+                Lease(
+                    self.leases,
+                    f"dialog:{user_id}",
+                    self.instance_id,
+                    ttl=timedelta(seconds=30),
+                )
+            ),
+            # In seconds, 0 keeps conversations until they are completed
+            idle_timeout=int(environ.get("DIALOG_IDLE_TIMEOUT", "86400")) or None,
+            wheel=TimingWheel(tick=int(environ.get("DIALOG_IDLE_TICK", "60"))),
+        )
@@ -1,13 +1,32 @@
-from asyncio import as_completed, gather, sleep
+from asyncio import Task, as_completed, create_task, gather
 from datetime import datetime, timedelta
+from functools import cache
 from os import environ
-from typing import Optional
+from typing import Optional, get_args
 
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, InsertOne, UpdateOne
 from pymongo.collection import ReturnDocument
-from pymongo.results import DeleteResult, InsertOneResult, UpdateResult
-from telegram.ext import ContextTypes
-
-from app import chats, clean_up_db, logs
+from pymongo.errors import DuplicateKeyError
+from pymongo.results import DeleteResult, UpdateResult
+from telegram import Bot
+
+from app import (
+    clean_up_db,
+    ctx,
+    instance_id,
+    log_retention,
+    pending_ttl,
+    recent_updates,
+    scheduler,
+    settings_cache,
+    worker_index,
+    workers,
+)
+from app.lease import Lease, heartbeat
+from app.metrics import sweep_duration, sweep_items
+from app.ratelimiter import BULK
+from app.scheduler import EXPIRE_AFTER, REMIND_AFTER, SWEEP_EVERY, DeadlineKind
 from app.types import (
     ChatId,
     Log,
@@ -16,6 +35,7 @@ from app.types import (
     Questionnaire,
     ServiceLog,
     Settings,
+    Settings_keys,
     Status,
     User,
     UserId,
@@ -24,30 +44,116 @@ from app.types import (
 )
 from app.utils import mark_successful_coroutines, run_coroutines_masked
 
+""" Indexes """
+
+
+async def ensure_indexes() -> None:
+    await gather(
+        ctx.logs.create_index(
+            [("chat_id", ASCENDING), ("operation", ASCENDING), ("at", ASCENDING)]
+        ),
+        ctx.logs.create_index([("operation", ASCENDING), ("at", ASCENDING)]),
+        ctx.logs.create_index(
+            [("operation", ASCENDING), ("notified", ASCENDING), ("at", ASCENDING)]
+        ),
+        ctx.chats.create_index("chat_id"),
+        ctx.pending_requests.create_index(
+            [("chat_id", ASCENDING), ("user_id", ASCENDING)], unique=True
+        ),
+        ctx.pending_requests.create_index("at", expireAfterSeconds=pending_ttl),
+        ctx.digests.create_index("at", expireAfterSeconds=pending_ttl),
+        ctx.leases.create_index("expires_at", expireAfterSeconds=0),
+        ctx.updates.create_index("at", expireAfterSeconds=recent_updates.ttl),
+        ctx.answers.create_index(
+            [("user_id", ASCENDING), ("chat_id", ASCENDING)], unique=True
+        ),
+        ctx.answers.create_index("at", expireAfterSeconds=pending_ttl),
+    )
+
+
+def retention_policy(spec: str) -> dict[Operation, int]:
+    # Days to keep logs per operation: 30 for all but 'background_task' by default,
+    # overridden by a spec such as "wants_to_join=7,background_task=90,replying_to_bot=off"
+    policy: dict[Operation, int] = {
+        op: 30 for op in get_args(Operation) if op != "background_task"
+    }
+    for pair in spec.split(","):
+        if "=" not in pair:
+            continue
+        op, days = (x.strip() for x in pair.split("=", 1))
+        if days == "off":
+            policy.pop(op, None)
+        else:
+            policy[op] = int(days)
+    return policy
+
+
+async def apply_retention() -> dict[Operation, int]:
+    # Mongo expires the logs itself, through one partial TTL index per operation
+    policy = retention_policy(log_retention) if clean_up_db else {}
+    existing = await ctx.logs.index_information()
+
+    for name in existing:
+        if name.startswith("ttl_") and name[len("ttl_") :] not in policy:
+            await ctx.logs.drop_index(name)
+
+    for op, days in policy.items():
+        name, seconds = f"ttl_{op}", days * 86400
+        if name not in existing:
+            await ctx.logs.create_index(
+                "at",
+                name=name,
+                expireAfterSeconds=seconds,
+                partialFilterExpression={"operation": op},
+            )
+        elif existing[name].get("expireAfterSeconds") != seconds:
+            await ctx.logs.database.command(
+                "collMod",
+                ctx.logs.name,
+                index={"name": name, "expireAfterSeconds": seconds},
+            )
+    return policy
+
+
 """ Settings """
 
+settings_fields = {"_id": 0} | {k: 1 for k in Settings_keys}
+
 
 async def fetch_settings(chat_id: ChatId) -> Settings | None:
-    if doc := await chats.find_one({"chat_id": chat_id}):
-        return Settings(doc)
+    if cached := settings_cache.fetch(chat_id):
+        return cached
+
+    if doc := await ctx.chats.find_one(
+        {"chat_id": chat_id}, projection=settings_fields
+    ):
+        settings = Settings(doc)
+        settings_cache.put(chat_id, settings)
+        return settings
 
 
 async def reset(chat_id: ChatId) -> DeleteResult:
-    return await chats.delete_one({"chat_id": chat_id})
+    settings_cache.invalidate(chat_id)
+    return await ctx.chats.delete_one({"chat_id": chat_id})
 
 
 async def upsert_settings(settings: Settings) -> Settings | None:
-    if updated := await chats.find_one_and_update(
+    settings_cache.invalidate(settings.chat_id)
+    if updated := await ctx.chats.find_one_and_update(
         {"chat_id": settings.chat_id},
         {"$set": settings.as_dict()},
         upsert=True,
+        projection=settings_fields,
         return_document=ReturnDocument.AFTER,
     ):
-        return Settings(updated)
+        refreshed = Settings(updated)
+        settings_cache.put(settings.chat_id, refreshed)
+        return refreshed
 
 
 async def upsert_questionnaire(chat_id: ChatId, q: Questionnaire) -> UpdateResult:
-    return await chats.find_one_and_update(
+    settings_cache.invalidate(chat_id)
+    return await ctx.chats.find_one_and_update(
         {"chat_id": chat_id}, {"$set": {"questionnaire": q._asdict()}}, upsert=True
     )
 
@@ -56,7 +162,7 @@ async def upsert_questionnaire(chat_id: ChatId, q: Questionnaire) -> UpdateResul
 
 
 async def fetch_chat_ids() -> list[ChatId]:
-    cursor = chats.find()
+    cursor = ctx.chats.find()
     users_id = []
     async for doc in cursor:
         if "chat_id" in doc and ("changelog" not in doc or doc["changelog"] != "off"):
@@ -65,80 +171,213 @@ async def fetch_chat_ids() -> list[ChatId]:
 
 
 async def remove_chats(chats_ids: list[ChatId]) -> DeleteResult:
-    return await chats.delete_many({"chat_id": {"$in": chats_ids}})
+    for chat_id in chats_ids:
+        settings_cache.invalidate(chat_id)
+    return await ctx.chats.delete_many({"chat_id": {"$in": chats_ids}})
 
 
-async def add_pending(
-    chat_id: ChatId, user_id: UserId, message_id: MessageId
-) -> UpdateResult:
-    user_key = f"pending_{user_id}"
-    payload = {"message_id": message_id, "at": datetime.now()}
-    return await chats.find_one_and_update(
-        {"chat_id": chat_id}, {"$set": {user_key: payload}}
+async def add_pending(chat_id: ChatId, user_id: UserId, message_id: MessageId) -> None:
+    await ctx.pending_requests.update_one(
+        {"chat_id": chat_id, "user_id": user_id},
+        {"$set": {"message_id": message_id, "at": datetime.now()}},
+        upsert=True,
     )
 
 
 async def remove_pending(chat_id: ChatId, user_id: UserId) -> None | int:
-    doc = await chats.find_one_and_update(
-        {"chat_id": chat_id}, {"$unset": {f"pending_{user_id}": ""}}
-    )
-    if f"pending_{user_id}" in doc:
-        return doc[f"pending_{user_id}"]["message_id"]
+    if doc := await ctx.pending_requests.find_one_and_delete(
+        {"chat_id": chat_id, "user_id": user_id}
+    ):
+        return doc["message_id"]
 
 
-async def get_banners() -> list[ChatId]:
-    banners = []
-    cursor = chats.find(
-        {"chat_id": {"$exists": True}, "ban_not_joining": {"$exists": True}}
+""" Digests: pending join requests notified together, tracked per message """
+
+
+def _digest_id(digest_id: str) -> ObjectId | None:
+    return ObjectId(digest_id) if ObjectId.is_valid(digest_id) else None
+
+
+async def add_digest(
+    chat_id: ChatId, chat_name: str, alert: str, users: list[tuple[UserId, str]]
+) -> dict:
+    digest = {
+        "chat_id": chat_id,
+        "chat_name": chat_name,
+        "alert": alert,
+        "users": [{"user_id": uid, "user_name": name} for uid, name in users],
+        "page": 0,
+        "at": datetime.now(),
+    }
+    result = await ctx.digests.insert_one(digest)
+    return digest | {"_id": result.inserted_id}
+
+
+async def set_digest_message(
+    digest_id: ObjectId, destination: ChatId, message_id: MessageId
+) -> None:
+    await ctx.digests.update_one(
+        {"_id": digest_id},
+        {"$set": {"destination": destination, "message_id": message_id}},
     )
-    async for doc in cursor:
-        if doc["ban_not_joining"] is True:
-            banners.append(doc["chat_id"])
-    return banners
 
 
-async def get_status(chat_id: ChatId) -> None | Status:
-    def extract(d: dict) -> UserWithName:
-        user_id = d["user_id"]
-        user_name = d["username"]
-        at = d["at"]
-        return UserWithName(user_id=user_id, user_name=user_name, at=at)
+async def set_digest_page(digest_id: str, page: int) -> dict | None:
+    return await ctx.digests.find_one_and_update(
+        {"_id": _digest_id(digest_id)},
+        {"$set": {"page": page}},
+        return_document=ReturnDocument.AFTER,
+    )
 
-    cursor = logs.find(
-        {
-            "at": {"$exists": True},
-            "user_id": {"$exists": True},
-            "username": {"$exists": True},
-            "chat_id": {"$exists": True},
-            "operation": {"$exists": True},
-        }
+
+async def pull_from_digest(digest_id: str, user_id: UserId) -> dict | None:
+    # Only one admin gets to handle a given user
+    return await ctx.digests.find_one_and_update(
+        {"_id": _digest_id(digest_id), "users.user_id": user_id},
+        {"$pull": {"users": {"user_id": user_id}}},
+        return_document=ReturnDocument.AFTER,
     )
 
-    notified: list[UserWithName] = []
-    pending: list[UserWithName] = []
-    prebanned: list[UserWithName] = []
-    is_banned: Operation = "is_banned"
-    wants_to_join: Operation = "wants_to_join"
 
-    async for doc in cursor:
-        user = extract(doc)
+async def remove_digest(digest_id: str) -> dict | None:
+    return await ctx.digests.find_one_and_delete({"_id": _digest_id(digest_id)})
 
-        if doc["operation"] == is_banned:
-            prebanned.append(user)
 
-        elif "notified" in doc:
-            notified.append(user)
+async def migrate_pending() -> int:
+    # One-off: moves the `pending_<user_id>` keys once embedded in chats documents to their own collection
+    moved = 0
+    async for doc in ctx.chats.find({"chat_id": {"$exists": True}}):
+        keys = [k for k in doc if k.startswith("pending_")]
+        if not keys:
+            continue
+
+        await ctx.pending_requests.bulk_write(
+            [
+                UpdateOne(
+                    {"chat_id": doc["chat_id"], "user_id": int(k[len("pending_") :])},
+                    {"$setOnInsert": doc[k]},
+                    upsert=True,
+                )
+                for k in keys
+            ]
+        )
+        await ctx.chats.update_one(
+            {"_id": doc["_id"]}, {"$unset": {k: "" for k in keys}}
+        )
+        moved += len(keys)
+    return moved
+
+
+async def migrate_answers() -> int:
+    # One-off: moves the answers once held by the stored dialogs to their own collection
+    moved = 0
+    async for doc in ctx.db["dialogs"].find({"answers": {"$exists": True}}):
+        if answers := doc["answers"]:
+            await ctx.answers.update_one(
+                {"user_id": doc["user_id"], "chat_id": doc["chat_id"]},
+                {
+                    "$set": {f"answers.{n}": a for n, a in enumerate(answers)}
+                    | {"at": datetime.now()}
+                },
+                upsert=True,
+            )
+        await ctx.db["dialogs"].update_one(
+            {"_id": doc["_id"]},
+            {"$set": {"answered": len(answers)}, "$unset": {"answers": ""}},
+        )
+        moved += 1
+    return moved
+
+
+async def get_banners() -> list[ChatId]:
+    cursor = ctx.chats.find(
+        {"chat_id": {"$exists": True}, "ban_not_joining": True},
+        projection={"_id": 0, "chat_id": 1},
+    )
+    return [doc["chat_id"] async for doc in cursor]
 
-        elif doc["operation"] == wants_to_join:
-            pending.append(user)
 
-    operation: Operation = "background_task"
-    cursor = logs.find({"operation": operation})
+async def get_status(chat_id: ChatId) -> None | Status:
+    is_banned: Operation = "is_banned"
+    wants_to_join: Operation = "wants_to_join"
+    background: Operation = "background_task"
 
-    ats = sorted([doc["at"] async for doc in cursor if "at" in doc])
-    work_summary = f"Chat has operated since {ats[0]} and has run {len(ats)} background tasks since, with the latest at: {ats[-1]}"
+    # Scoped to the chat, on the (chat_id, operation, at) index: the cost grows with the chat, not with the logs
+    pipeline = [
+        {
+            "$match": {
+                "chat_id": chat_id,
+                "at": {"$exists": True},
+                "user_id": {"$exists": True},
+                "username": {"$exists": True},
+            }
+        },
+        {
+            "$project": {
+                "user_id": 1,
+                "username": 1,
+                "at": 1,
+                "category": {
+                    "$switch": {
+                        "branches": [
+                            {
+                                "case": {"$eq": ["$operation", is_banned]},
+                                "then": "prebanned",
+                            },
+                            {
+                                "case": {"$eq": ["$notified", True]},
+                                "then": "notified",
+                            },
+                            {
+                                "case": {"$eq": ["$operation", wants_to_join]},
+                                "then": "pending",
+                            },
+                        ],
+                        "default": None,
+                    }
+                },
+            }
+        },
+        {"$match": {"category": {"$ne": None}}},
+        {
+            "$group": {
+                "_id": "$category",
+                "users": {
+                    "$push": {
+                        "user_id": "$user_id",
+                        "username": "$username",
+                        "at": "$at",
+                    }
+                },
+            }
+        },
+    ]
+    # First and last background runs, each read off one end of the (operation, at) index
+    runs = {"operation": background, "at": {"$exists": True}}
+
+    await ctx.log_writer.flush()
+    groups, first, last = await gather(
+        ctx.logs.aggregate(pipeline).to_list(length=None),
+        ctx.logs.find_one(runs, projection={"at": 1}, sort=[("at", ASCENDING)]),
+        ctx.logs.find_one(runs, projection={"at": 1}, sort=[("at", DESCENDING)]),
+    )
 
-    if notified + pending + prebanned + ats:
+    grouped = {
+        group["_id"]: [
+            UserWithName(user_id=d["user_id"], user_name=d["username"], at=d["at"])
+            for d in group["users"]
+        ]
+        for group in groups
+    }
+    pending = grouped.get("pending", [])
+    notified = grouped.get("notified", [])
+    prebanned = grouped.get("prebanned", [])
+
+    work_summary = ""
+    if first and last:
+        work_summary = f"Chat has operated since {first['at']}, with the latest background task at: {last['at']}"
+
+    if notified or pending or prebanned or work_summary:
         return Status(
             chat_id,
             pending,
@@ -152,7 +391,7 @@ async def get_status(chat_id: ChatId) -> None | Status:
 
 
 async def check_if_banned(chat_id: ChatId, user_ids: list[UserId]) -> list[UserId]:
-    cursor = logs.find(
+    cursor = ctx.logs.find(
         {"user_id": {"$in": user_ids}, "chat_id": chat_id, "operation": "is_banned"}
     )
     user_ids = []
@@ -161,40 +400,23 @@ async def check_if_banned(chat_id: ChatId, user_ids: list[UserId]) -> list[UserI
     return user_ids
 
 
-async def remove_old_logs(now: Optional[datetime] = None) -> DeleteResult:
-    if not now:
-        now = datetime.now()
-
-    operation: Operation = "background_task"
-    t0 = now - timedelta(days=30)
-    return await logs.delete_many({"operation": {"$ne": operation}, "at": {"$lt": t0}})
-
-
-async def mark_as_banned(user: User) -> UpdateResult:
-    op: Operation = "is_banned"
-    return await logs.find_one_and_update(
-        {"user_id": user.user_id, "chat_id": user.chat_id}, {"$set": {"operation": op}}
-    )
-
-
 async def preban(
-    context: ContextTypes.DEFAULT_TYPE | None, users: list[User]
+    bot: Bot | None, users: list[User]
 ) -> tuple[list[User], list[User]] | None:
-    if not context:
+    if not bot:
         return
 
     async def accept_then_ban(user: User) -> tuple[bool, User]:
         try:
-            await context.bot.approve_chat_join_request(
+            await bot.approve_chat_join_request(
                 user.chat_id,
                 user.user_id if isinstance(user.user_id, int) else int(user.user_id),
+                rate_limit_args=BULK,
             )
-            await context.bot.ban_chat_member(user.chat_id, user.user_id)
-            return banned, user
+            await bot.ban_chat_member(user.chat_id, user.user_id, rate_limit_args=BULK)
+            return True, user
         except Exception:
             return False, user
-        finally:
-            await mark_as_banned(user)
 
     failed_to_ban_but_invited = []
     successfully_banned = []
@@ -210,7 +432,7 @@ async def preban(
 
 
 async def get_users_at(chat_id: ChatId, user_ids: list[UserId]) -> list[datetime]:
-    cursor = logs.find(
+    cursor = ctx.logs.find(
         {
             "chat_id": chat_id,
             "user_id": {"$in": user_ids},
@@ -225,197 +447,369 @@ async def get_users_at(chat_id: ChatId, user_ids: list[UserId]) -> list[datetime
     return datetimes
 
 
-async def log(to_log: Log) -> InsertOneResult | UpdateResult:
+async def log(to_log: Log) -> None:
+    # Write-behind: the log writer batches these into bulk writes
     match to_log:
         case ServiceLog():
-            return await logs.insert_one(to_log.as_dict())
+            await ctx.log_writer.write(InsertOne(to_log.as_dict()))
 
         case UserLog():
-            return await logs.find_one_and_update(
-                {"user_id": to_log.user_id, "chat_id": to_log.chat_id},
-                {"$set": to_log.as_dict()},
-                upsert=True,
+            await ctx.log_writer.write(
+                UpdateOne(
+                    {"user_id": to_log.user_id, "chat_id": to_log.chat_id},
+                    {"$set": to_log.as_dict()},
+                    upsert=True,
+                )
             )
 
 
-async def mark_as_notified(user: User) -> User | None:
-    updated = await logs.find_one_and_update(
-        {"user_id": user.user_id, "chat_id": user.chat_id}, {"$set": {"notified": True}}
+async def claim_reminder(user: User) -> bool:
+    # Marks the user as notified before reminding them, atomically,
+    # so that a single instance gets to remind them
+    operation: Operation = "wants_to_join"
+    return bool(
+        await ctx.logs.find_one_and_update(
+            {
+                "user_id": user.user_id,
+                "chat_id": user.chat_id,
+                "operation": operation,
+                "notified": {"$exists": False},
+            },
+            {"$set": {"notified": True}},
+            projection={"_id": 1},
+        )
     )
-    if updated:
-        return user
 
 
-busy = False
+""" Questionnaire answers, stored as they come """
 
 
-async def background_task(context: ContextTypes.DEFAULT_TYPE | None) -> None | int:
-    """
-    Run a background task at most every minute on the chat_id corresponding to the calling handler.
-    The logic is:
-    - if a user has not joined within the next 20 minutes after landing a join request, they get notified
-    - if a user has been notified and does not join within the next 5h40, they get banned if the chat declares a ban_not_joining setting or
-        if it doesn't, they get declined and removed from the database.
-    - all database logs older than 30 days get removed unless they bear the 'background_task' label.
-    """
-
-    # Setup
-    global busy
+async def save_answer(user_id: UserId, chat_id: ChatId, n: int, answer: str) -> None:
+    # Keyed by position: an answer received twice is stored once
+    await ctx.answers.update_one(
+        {"user_id": user_id, "chat_id": chat_id},
+        {"$set": {f"answers.{n}": answer, "at": datetime.now()}},
+        upsert=True,
+    )
 
-    if context:
-        await sleep(60)
-    if busy:
-        return busy
 
-    now = datetime.now()
-    h6 = timedelta(hours=6)
-    min20 = timedelta(minutes=20)
-
-    due = lambda item, delt: now - item["at"] >= delt
-    tried_6h_ago_and_got_alert = (
-        lambda item: due(item, h6)
-        and item["operation"] == "wants_to_join"
-        and "notified" in item
-    )
-    tried_20min_ago_and_not_alerted = (
-        lambda item: due(item, min20)
-        and item["operation"] == "wants_to_join"
-        and not "notified" in item
+async def fetch_answers(user_id: UserId, chat_id: ChatId) -> list[str]:
+    doc = await ctx.answers.find_one(
+        {"user_id": user_id, "chat_id": chat_id}, projection={"_id": 0, "answers": 1}
     )
-    hh = lambda uid, cid: str(uid) + "_" + str(cid)
+    answers = doc.get("answers", {}) if doc else {}
+    return [answers[n] for n in sorted(answers, key=int)]
 
-    # Preparing query
+
+async def remove_answers(user_id: UserId, chat_id: ChatId) -> None:
+    await ctx.answers.delete_one({"user_id": user_id, "chat_id": chat_id})
+
+
+async def claim_update(update_id: int) -> bool:
+    # Only one worker gets to process an update, however many times Telegram delivers it
     try:
-        busy = True
-        to_deny_and_remove: list[User] = []
-        to_notify: list[User] = []
-        to_ban: list[User] = []
-        banned: set[str] = set()
-        banners = await get_banners()
+        await ctx.updates.insert_one({"_id": update_id, "at": datetime.now()})
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+async def unmark_as_notified(user: User) -> None:
+    await ctx.log_writer.write(
+        UpdateOne(
+            {"user_id": user.user_id, "chat_id": user.chat_id},
+            {"$unset": {"notified": ""}},
+        )
+    )
+
+
+async def claim_expired(user: User, ban: bool) -> bool:
+    # Atomically flags the user as banned, or removes their log,
+    # so that a single instance gets to ban or decline them
+    operation: Operation = "wants_to_join"
+    query = {
+        "user_id": user.user_id,
+        "chat_id": user.chat_id,
+        "operation": operation,
+        "notified": True,
+    }
+    if ban:
         is_banned: Operation = "is_banned"
-        cursor = logs.find(
-            {
-                "at": {"$exists": True},
-                "user_id": {"$exists": True},
-                "chat_id": {"$exists": True},
-                "operation": {"$exists": True},
-            }
+        return bool(
+            await ctx.logs.find_one_and_update(
+                query, {"$set": {"operation": is_banned}}, projection={"_id": 1}
+            )
         )
+    return bool(await ctx.logs.find_one_and_delete(query, projection={"_id": 1}))
+
+
+""" Follow-ups """
+
+
+# User ids looked up per query when checking which deadlines are still due
+DUE_BATCH = 500
+
+
+async def fetch_due(
+    cutoff: datetime,
+    notified: bool,
+    among: Optional[list[User]] = None,
+    shards: Optional[list[int]] = None,
+) -> list[User]:
+    # Served by the (operation, notified, at) index
+    operation: Operation = "wants_to_join"
+    query: dict = {
+        "operation": operation,
+        "notified": {"$exists": notified},
+        "at": {"$lte": cutoff},
+    }
+    if shards is not None:
+        query.update(shard_filter(shards))
+    if among is None:
+        return await find_users(query)
+
+    # Per chat and by batches of user ids, so that queries keep the same size after a long outage
+    by_chat: dict[ChatId, list[UserId]] = {}
+    for user in among:
+        by_chat.setdefault(user.chat_id, []).append(user.user_id)
+    due: list[User] = []
+    for chat_id, user_ids in by_chat.items():
+        for i in range(0, len(user_ids), DUE_BATCH):
+            batch = user_ids[i : i + DUE_BATCH]
+            due += await find_users(
+                query | {"chat_id": chat_id, "user_id": {"$in": batch}}
+            )
+    return due
 
-        # Collecting results
-        async for u in cursor:
-            if not "user_id" in u or not "chat_id" in u:
-                continue
 
-            uid = u["user_id"]
-            cid = u["chat_id"]
+async def find_users(query: dict) -> list[User]:
+    cursor = ctx.logs.find(query, projection={"_id": 0, "user_id": 1, "chat_id": 1})
+    return [User(doc["user_id"], doc["chat_id"]) async for doc in cursor]
 
-            if u["operation"] == is_banned:
-                banned.add(hh(uid, cid))
 
-            if tried_20min_ago_and_not_alerted(u):
-                to_notify.append(User(u["user_id"], u["chat_id"]))
+async def schedule_pending() -> int:
+    # Rebuilds the scheduler from the join requests still waiting in the logs, in this worker's shard only:
+    # the other shards are scheduled by their own worker, or caught up on by the sweep of whoever took them over
+    operation: Operation = "wants_to_join"
+    cursor = ctx.logs.find(
+        {"operation": operation, "at": {"$exists": True}}
+        | shard_filter([worker_index]),
+        projection={"_id": 0, "user_id": 1, "chat_id": 1, "at": 1, "notified": 1},
+    )
+    n = 0
+    async for doc in cursor:
+        user = User(doc["user_id"], doc["chat_id"])
+        if "notified" not in doc:
+            scheduler.schedule(doc["at"] + REMIND_AFTER, "remind", user)
+        scheduler.schedule(doc["at"] + EXPIRE_AFTER, "expire", user)
+        n += 1
+    scheduler.schedule(datetime.now() + SWEEP_EVERY, "sweep")
+    return n
+
+
+async def remind(bot: Bot, users: list[User]) -> list[User]:
+    claims = await gather(*[claim_reminder(user) for user in users])
+    claimed = [user for user, claim in zip(users, claims) if claim]
+
+    # Notifying & marking success
+    successfully_notified = await gather(
+        *[
+            mark_successful_coroutines(
+                user,
+                bot.send_message(
+                    user.user_id,
+                    "Hey, some 20 minutes ago I tried handle your request to join our group, perhaps you've missed it? How about scrolling up a bit? :)",
+                    rate_limit_args=BULK,
+                ),
+            )
+            for user in claimed
+        ]
+    )
 
-            if tried_6h_ago_and_got_alert(u):
-                if u["chat_id"] in banners:
-                    if not hh(uid, cid) in banned:
-                        to_ban.append(User(u["user_id"], u["chat_id"]))
-                else:
-                    to_deny_and_remove.append(User(u["user_id"], u["chat_id"]))
+    # Failed reminders are given another chance by the next sweep
+    await gather(
+        *[
+            unmark_as_notified(user)
+            for user, notified in zip(claimed, successfully_notified)
+            if notified is None
+        ]
+    )
+    return [user for user in successfully_notified if user is not None]
 
-        # Only for testing purposes
-        if not context:
-            busy = False
-            return len(to_deny_and_remove) + len(to_notify)
 
-        # Removing, declining and notifying
-        deleted: DeleteResult = await logs.delete_many(
-            {
-                "user_id": {"$in": [u.user_id for u in to_deny_and_remove]},
-                "chat_id": {"$in": [u.chat_id for u in to_deny_and_remove]},
-            }
-        )
+async def expire(bot: Bot, users: list[User]) -> str:
+    banners = await get_banners()
 
-        # Declining pending join requests with exceptions masked
-        # as there is no way to determine with certainty if the target join request was taken back or not
-        async def deny_notify(user: User):
-            denied = await context.bot.decline_chat_join_request(
-                user.chat_id,
-                user.user_id if isinstance(user.user_id, int) else int(user.user_id),
+    # Flagging as banned or removing, so that they are no longer waiting
+    claims = await gather(
+        *[claim_expired(user, ban=user.chat_id in banners) for user in users]
+    )
+    claimed = [user for user, claim in zip(users, claims) if claim]
+    to_ban = [user for user in claimed if user.chat_id in banners]
+    to_deny_and_remove = [user for user in claimed if user.chat_id not in banners]
+
+    # Declining pending join requests with exceptions masked
+    # as there is no way to determine with certainty if the target join request was taken back or not
+    async def deny_notify(user: User):
+        denied = await bot.decline_chat_join_request(
+            user.chat_id,
+            user.user_id if isinstance(user.user_id, int) else int(user.user_id),
+            rate_limit_args=BULK,
+        )
+        if denied:
+            await bot.send_message(
+                user.user_id,
+                "Too much time has elapsed. Please request joining again.",
+                rate_limit_args=BULK,
             )
-            if denied:
-                await context.bot.send_message(
-                    user.user_id,
-                    "Too much time has elapsed. Please request joining again.",
-                )
 
-        await run_coroutines_masked([deny_notify(user) for user in to_deny_and_remove])
-
-        # Notifying & marking success
-        successfully_notified = await gather(
-            *[
-                mark_successful_coroutines(
-                    user,
-                    context.bot.send_message(
-                        user.user_id,
-                        "Hey, some 20 minutes ago I tried handle your request to join our group, perhaps you've missed it? How about scrolling up a bit? :)",
-                    ),
-                )
-                for user in to_notify
-            ]
+    await run_coroutines_masked([deny_notify(user) for user in to_deny_and_remove])
+
+    # Banning & notifying
+    report = f"{len(to_deny_and_remove)} deleted."
+
+    if to_ban:
+        await bot.send_message(
+            environ["ADMIN"],
+            f"Banning these users: {', '.join([u.render() for u in to_ban])}",
+        )
+
+    if mb_banned := await preban(bot, to_ban):
+        failed_to_ban, confirmed_banned = mb_banned
+        report += "\n".join(
+            [f" Failed to banned: {u.user_id} from {u.chat_id}." for u in failed_to_ban]
         )
-        confirmed_notified = await gather(
-            *[
-                mark_as_notified(user)
-                for user in successfully_notified
-                if user is not None
+        report += "\n".join(
+            [
+                f" Successfully banned: {u.user_id} from {u.chat_id}."
+                for u in confirmed_banned
             ]
         )
 
-        # Banning & notifying
-        banning_report_failed = ""
-        banning_report_success = ""
+    return report
 
-        if to_ban:
-            await context.bot.send_message(
-                environ["ADMIN"],
-                f"Banning these users: {', '.join([u.render() for u in to_ban])}",
-            )
 
-        if mb_banned := await preban(context, to_ban):
-            failed_to_ban, confirmed_banned = mb_banned
-            banning_report_failed += "\n".join(
-                [
-                    f" Failed to banned: {u.user_id} from {u.chat_id}."
-                    for u in failed_to_ban
-                ]
-            )
-            banning_report_success += "\n".join(
-                [
-                    f" Successfully banned: {u.user_id} from {u.chat_id}."
-                    for u in confirmed_banned
-                ]
-            )
+async def process_due(bot: Bot, kind: DeadlineKind, users: list[User]) -> None:
+    now = datetime.now()
+    if kind == "sweep":
+        # Re-armed before anything can fail: a failed sweep must not stop the next ones
+        scheduler.schedule(now + SWEEP_EVERY, "sweep")
+
+    # Deadlines are only hints: the logs tell whether the user is still waiting
+    await ctx.log_writer.flush()
+
+    match kind:
+        case "remind":
+            if due := await fetch_due(now - REMIND_AFTER, notified=False, among=users):
+                await remind(bot, due)
+
+        case "expire":
+            if due := await fetch_due(now - EXPIRE_AFTER, notified=True, among=users):
+                await expire(bot, due)
+
+        case "sweep":
+            await background_task(bot)
+
+
+""" Sweep leases """
+
+SWEEP_LEASE_TTL = timedelta(minutes=1)
+
+
+# Chats are split into one shard per worker. Each worker keeps the lease on its own shard alive
+# and sweeps it; the shard of a worker that stopped renewing its lease is taken over by the others.
+@cache
+def sweep_leases() -> list[Lease]:
+    return [
+        Lease(ctx.leases, f"background_task:{shard}", instance_id, ttl=SWEEP_LEASE_TTL)
+        for shard in range(workers)
+    ]
+
+
+def shard_filter(shards: list[int]) -> dict:
+    if len(shards) >= workers:
+        return {}
+    shard = {"$mod": [{"$abs": {"$toLong": "$chat_id"}}, workers]}
+    return {"$expr": {"$in": [shard, shards]}}
+
+
+def keep_sweep_lease() -> Task:
+    return create_task(heartbeat(sweep_leases()[worker_index]))
+
+
+async def release_sweep_lease():
+    await sweep_leases()[worker_index].release()
+
+
+async def background_task(bot: Bot | None) -> None | bool | int:
+    """
+    Sweep the logs for join requests whose follow-up is due. Follow-ups are normally fired by the scheduler
+    at the exact deadline, this sweep catches up on whatever was missed (restarts, requests logged by another instance).
+    The logic is:
+    - if a user has not joined within the next 20 minutes after landing a join request, they get notified
+    - if a user has been notified and does not join within the next 5h40, they get banned if the chat declares a ban_not_joining setting or
+        if it doesn't, they get declined and removed from the database.
+    Only the shards whose lease could be acquired are swept, so that no two instances handle the same chat.
+    """
+
+    # Setup
+    now = datetime.now()
+    shards: list[int] = []
+    renewing: list[Task] = []
+
+    # Preparing query
+    try:
+        shards = [
+            shard for shard, lease in enumerate(sweep_leases()) if await lease.acquire()
+        ]
+        if not shards:
+            return True
+        # Leases taken over from other workers are kept alive for the duration of the run
+        renewing = [
+            create_task(heartbeat(sweep_leases()[shard]))
+            for shard in shards
+            if shard != worker_index
+        ]
+
+        await ctx.log_writer.flush()
+        # Only documents that are actually due are fetched. Logs are upserted per (user_id, chat_id),
+        # so a banned user's document no longer reads 'wants_to_join' and never shows up here.
+        to_notify, expired = await gather(
+            fetch_due(now - REMIND_AFTER, notified=False, shards=shards),
+            fetch_due(now - EXPIRE_AFTER, notified=True, shards=shards),
+        )
+
+        # Only for testing purposes
+        if not bot:
+            return len(expired) + len(to_notify)
+
+        confirmed_notified = await remind(bot, to_notify)
+        expired_report = await expire(bot, expired)
 
         # Logging
         elapsed_time = datetime.now() - now
+        sweep_duration.observe(elapsed_time.total_seconds())
+        sweep_items.set(len(to_notify), kind="remind")
+        sweep_items.set(len(confirmed_notified), kind="notified")
+        sweep_items.set(len(expired), kind="expire")
         await log(
             ServiceLog(
                 "background_task",
-                f"Job completed within {elapsed_time}, with {len(successfully_notified)} notified users found late on joining, {len(confirmed_notified)} logs edited and {deleted.deleted_count} deleted."
-                + banning_report_failed
-                + banning_report_success,
+                f"Job completed within {elapsed_time} on shards {shards} of {workers}, with {len(to_notify)} users found late on joining, {len(confirmed_notified)} notified and logs edited, {len(expired)} expired and "
+                + expired_report
+                + f" Settings cache: {settings_cache.stats}."
+                + f" Log writer: {ctx.log_writer.stats}.",
             )
         )
 
-        # Removing old entries
-        if clean_up_db:
-            await remove_old_logs()
-
     except Exception as error:
-        if context:
-            await context.bot.send_message(environ["ADMIN"], str(error))
+        if bot:
+            await bot.send_message(environ["ADMIN"], str(error))
         else:
             print(error)
     finally:
-        busy = False
+        for task in renewing:
+            task.cancel()
+        for shard in shards:
+            if shard != worker_index:
+                await sweep_leases()[shard].release()
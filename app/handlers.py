@@ -1,58 +1,138 @@
-from asyncio import create_task, gather
+from asyncio import gather
+from functools import partial
 from os import environ
 
-from telegram import Update
+from telegram import Bot, ChatMember, Update
 from telegram.constants import ChatType, ParseMode
-from telegram.ext import ContextTypes
+from telegram.ext import ApplicationHandlerStop, ContextTypes
 from telegram.helpers import escape_markdown
 
-from app import dialog_manager, strings
+from app import (
+    admins_cache,
+    ctx,
+    notifications,
+    notify_idle_dialogs,
+    recent_updates,
+    scheduler,
+    status_pages,
+    workers,
+)
+from app.callbacks import Callback, decode
 from app.db import (
+    add_digest,
     add_pending,
-    background_task,
     check_if_banned,
+    claim_update,
+    fetch_answers,
     fetch_chat_ids,
     fetch_settings,
     get_status,
     get_users_at,
     log,
+    pull_from_digest,
+    remove_answers,
     remove_chats,
+    remove_digest,
     remove_pending,
     reset,
+    save_answer,
+    set_digest_message,
+    set_digest_page,
     upsert_questionnaire,
     upsert_settings,
 )
+from app.metrics import duplicate_updates
+from app.ratelimiter import BULK
 from app.types import (
     ChatData,
     ChatId,
     ChatJoinRequestData,
     Dialog,
+    Extractor,
     Mode,
     Questionnaire,
     Reply,
     Settings,
+    User,
     UserId,
     UserLog,
 )
 from app.utils import (
     accept_or_reject_btns,
-    admins_ids_mkup,
     agree_btn,
     appropriate_emoji,
     average_nb_secs,
+    digest_page,
+    fetch_admins,
     fmt_delta,
     mark_excepted_coroutines,
+    mark_successful_coroutines,
     mention_markdown,
     slice_on_n,
+    status_btns,
     withAuth,
 )
 
+# Room left for the page number
+STATUS_PAGE_SIZE = 4096 - 16
+
+""" Dialogs extractors, rebuilt from the stored dialog whenever it is reloaded """
+
+
+def settings_extractor(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: ChatId
+) -> Extractor:
+    async def extractor_closure(
+        answers: list[str] | str,
+    ):
+        # Closure to extract the results of the questionnaire
+        rep = ""
+
+        if q := Questionnaire.parse(answers):
+            await upsert_questionnaire(chat_id, q)
+            rep = "Thanks, the questionnaire reads:\n" + q.render()
+
+        else:
+            rep = "Failed to parse your message into a valid questionnaire. Please start over."
+
+        await context.bot.send_message(chat_id, rep)
+
+    return extractor_closure
+
+
+def questionnaire_extractor(
+    context: ContextTypes.DEFAULT_TYPE, dialog: Dialog
+) -> Extractor:
+    async def extractor_closure() -> None:
+        # The report is built from the stored answers, which are not needed anymore once sent
+        answers = await fetch_answers(dialog.user_id, dialog.for_chat_id)
+        q_a = "\n".join(
+            [
+                f"Question: {escape_markdown(q)} => Answer: {escape_markdown(a)}"
+                for q, a in zip(dialog.questions, answers)
+            ]
+        )
+        reply = f"@{mention_markdown(dialog.user_id, dialog.user_name)} has just requested to join this chat. Their answers to the questionnaire are as follows:\n{escape_markdown(q_a)}"
+        keyboard = accept_or_reject_btns(
+            dialog.user_id, dialog.user_name, dialog.for_chat_id
+        )
+
+        await context.bot.send_message(
+            dialog.for_chat_id,
+            reply,
+            reply_markup=keyboard,
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        await remove_answers(dialog.user_id, dialog.for_chat_id)
+
+    return extractor_closure
+
 
 async def answering_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_data = ChatData.from_update(update)
     if not chat_data:
         return
-    reply = strings["commands"]["help"]
+    reply = ctx.strings["commands"]["help"]
     await context.bot.send_message(
         chat_data.chat_id,
         reply,
@@ -72,9 +152,11 @@ async def setting_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(s) == 1 or s[1] == "":
         # Get
         if fetched := await fetch_settings(chat_data.chat_id):
-            reply = strings["settings"]["settings"] + fetched.render(with_alert=True)
+            reply = ctx.strings["settings"]["settings"] + fetched.render(
+                with_alert=True
+            )
         else:
-            reply = strings["settings"]["none_found"]
+            reply = ctx.strings["settings"]["none_found"]
     elif settings := Settings(chat_data.message_text, chat_data.chat_id):
         # Set
         if updated := await upsert_settings(settings):
@@ -82,39 +164,25 @@ async def setting_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             # Setting up context for receiving Questionnaire settings
             if settings.mode == questionnaire:
-
-                async def extractor_closure(
-                    answers: list[str] | str,
-                ):
-                    # Closure to extract the results of the questionnaire
-                    rep = ""
-
-                    if q := Questionnaire.parse(answers):
-                        await upsert_questionnaire(chat_data.chat_id, q)
-                        rep = "Thanks, the questionnaire reads:\n" + q.render()
-
-                    else:
-                        rep = "Failed to parse your message into a valid questionnaire. Please start over."
-
-                    await context.bot.send_message(chat_data.chat_id, rep)
-
                 # Setting up state to detect the reply
-                dialog_manager.add(
+                await ctx.dialog_manager.put(
                     chat_data.user_id,
                     Reply(
                         chat_data.user_id,
                         chat_data.chat_id,
-                        extractor_closure,
+                        settings_extractor(context, chat_data.chat_id),
                     ),
                 )
                 reply = "Please *reply* to this message with an intro, questions, and an outro, separating each parts with a single linebreak. Example:\n_Intro_. This is my intro.\n_Q1_. This is a question.\n_Q2_.This is another question.\n_Outro_. This is the outro."
             else:
-                reply = strings["settings"]["updated"] + updated.render(with_alert=True)
+                reply = ctx.strings["settings"]["updated"] + updated.render(
+                    with_alert=True
+                )
         else:
-            reply = strings["settings"]["failed_to_update"]
+            reply = ctx.strings["settings"]["failed_to_update"]
     else:
         # No parse
-        reply = strings["settings"]["failed_to_parse"]
+        reply = ctx.strings["settings"]["failed_to_parse"]
     await context.bot.send_message(
         chat_data.chat_id,
         reply,
@@ -129,7 +197,7 @@ async def resetting(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not chat_data:
         return
 
-    reply = strings["settings"]["reset"]
+    reply = ctx.strings["settings"]["reset"]
     await gather(
         reset(chat_data.chat_id),
         context.bot.send_message(
@@ -143,13 +211,15 @@ async def wants_to_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not req:
         return
     admins, settings = await gather(
-        context.bot.get_chat_administrators(req.chat_id), fetch_settings(req.chat_id)
+        fetch_admins(context.bot, req.chat_id), fetch_settings(req.chat_id)
     )
-    alert = admins_ids_mkup(admins) if admins else ""
+    alert = admins.mkup
     # Missing settings
     if not settings:
         return await context.bot.send_message(
-            req.chat_id, strings["settings"]["missing"], disable_web_page_preview=True
+            req.chat_id,
+            ctx.strings["settings"]["missing"],
+            disable_web_page_preview=True,
         )
     # Paused
     if hasattr(settings, "paused") and settings.paused:
@@ -163,15 +233,12 @@ async def wants_to_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         settings.verification_msg
                         if settings.verification_msg
                         and len(settings.verification_msg) >= 10
-                        else strings["wants_to_join"]["verification_msg"],
+                        else ctx.strings["wants_to_join"]["verification_msg"],
                         disable_web_page_preview=True,
                         reply_markup=agree_btn(
-                            text=strings["wants_to_join"]["ok"],
+                            text=ctx.strings["wants_to_join"]["ok"],
                             from_chat_id=req.user_chat_id,
                             target_chat_id=req.chat_id,
-                            target_chat_url=strings["chat"]["url"]
-                            if not settings.chat_url
-                            else settings.chat_url,
                         ),
                     ),
                     log(
@@ -183,62 +250,33 @@ async def wants_to_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         )
                     ),
                 )
+                scheduler.register(User(req.from_user_id, req.chat_id))
 
             case "manual":
-
-                async def closure_send(destination: ChatId, text: str):
-                    response = await context.bot.send_message(
-                        destination,
-                        text,
-                        parse_mode=ParseMode.MARKDOWN,
-                        disable_web_page_preview=True,
-                        reply_markup=accept_or_reject_btns(
-                            req.from_user_id,
-                            req.from_user_name,
-                            req.chat_id,
-                            strings["chat"]["url"]
-                            if not settings.chat_url
-                            else settings.chat_url,
-                        ),
-                    )
-                    await add_pending(
-                        req.chat_id, req.from_user_id, response.message_id
-                    )
-
-                if hasattr(settings, "helper_chat_id") and settings.helper_chat_id:
-                    body = f"{mention_markdown(req.from_user_id, req.from_user_name)} has just asked to join your chat {mention_markdown(req.chat_id, req.chat_name)}, you might want to accept them."
-                    await closure_send(settings.helper_chat_id, alert + "\n" + body)
-                else:
-                    body = f"{mention_markdown(req.from_user_id, req.from_user_name)} just joined, but I couldn't find any chat to notify."
-                    await closure_send(req.chat_id, alert + "\n" + body)
+                # Requests arriving in a burst are notified together, see `notifying_admins`
+                await notifications.submit(
+                    req.chat_id,
+                    req,
+                    partial(notifying_admins, context.bot, settings, alert),
+                )
 
             case "questionnaire":
                 if q := settings.questionnaire:
-                    questions = q.questions
-
-                    async def extractor_closure(answers: list[str]) -> None:
-                        q_a = "\n".join(
-                            [
-                                f"Question: {escape_markdown(q)} => Answer: {escape_markdown(a)}"
-                                for q, a in zip(questions, answers)
-                            ]
-                        )
-                        reply = f"@{mention_markdown(req.from_user_id, req.from_user_name)} has just requested to join this chat. Their answers to the questionnaire are as follows:\n{escape_markdown(q_a)}"
-                        keyboard = accept_or_reject_btns(
-                            req.from_user_id, req.from_user_name, req.chat_id, ""
-                        )
-
-                        await context.bot.send_message(
-                            req.chat_id,
-                            reply,
-                            reply_markup=keyboard,
-                            parse_mode=ParseMode.MARKDOWN,
-                        )
-
-                    dialog = Dialog(req.from_user_id, req.chat_id, q, extractor_closure)
+                    dialog = Dialog(
+                        req.from_user_id,
+                        req.chat_id,
+                        q,
+                        None,
+                        user_name=req.from_user_name,
+                    )
+                    dialog.extractor = questionnaire_extractor(context, dialog)
                     dialog.start()
                     reply = dialog.take_reply()
-                    dialog_manager.add(req.from_user_id, dialog)
+                    # Leftovers of a previous attempt
+                    await gather(
+                        ctx.dialog_manager.put(req.from_user_id, dialog),
+                        remove_answers(req.from_user_id, req.chat_id),
+                    )
 
                     await context.bot.send_message(
                         req.user_chat_id, dialog.intro + ("\n" + reply) if reply else ""
@@ -248,20 +286,54 @@ async def wants_to_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 pass
 
 
-tasks = set()
+async def notifying_admins(
+    bot: Bot,
+    settings: Settings,
+    alert: str,
+    chat_id: ChatId,
+    requests: list[ChatJoinRequestData],
+):
+    destination = settings.helper_chat_id or chat_id
+    # The same user may have asked more than once
+    users = {req.from_user_id: req.from_user_name for req in requests}
+
+    if len(users) > 1:
+        digest = await add_digest(
+            chat_id, requests[0].chat_name, alert, [*users.items()]
+        )
+        text, keyboard = digest_page(digest)
+        response = await bot.send_message(
+            destination,
+            text,
+            parse_mode=ParseMode.MARKDOWN,
+            disable_web_page_preview=True,
+            reply_markup=keyboard,
+        )
+        await set_digest_message(digest["_id"], destination, response.message_id)
+        return
+
+    req = requests[-1]
+    if settings.helper_chat_id:
+        body = f"{mention_markdown(req.from_user_id, req.from_user_name)} has just asked to join your chat {mention_markdown(req.chat_id, req.chat_name)}, you might want to accept them."
+    else:
+        body = f"{mention_markdown(req.from_user_id, req.from_user_name)} just joined, but I couldn't find any chat to notify."
+    response = await bot.send_message(
+        destination,
+        alert + "\n" + body,
+        parse_mode=ParseMode.MARKDOWN,
+        disable_web_page_preview=True,
+        reply_markup=accept_or_reject_btns(
+            req.from_user_id, req.from_user_name, req.chat_id
+        ),
+    )
+    await add_pending(req.chat_id, req.from_user_id, response.message_id)
 
 
 async def replying_to_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Taking advantage of the fact that even with privacy mode off
     # the bot will be handed over all replies
-    t = create_task(background_task(context))
-    tasks.add(t)
-    t.add_done_callback(tasks.discard)
-
     if not (hasattr(update, "message") and hasattr(update.message, "reply_to_message")):
-        print(
-            f"Unable to make use of this update: {update}. Running background task instead"
-        )
+        print(f"Unable to make use of this update: {update}.")
         return
 
     if (
@@ -282,8 +354,14 @@ async def replying_to_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @withAuth
 async def processing_cbq(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    callback = (
+        decode(update.callback_query.data)
+        if hasattr(update.callback_query, "data") and update.callback_query.data
+        else None
+    )
+
     # Exiting on wrong data payload
-    if not hasattr(update.callback_query, "data") or not update.callback_query.data:
+    if not callback:
         await gather(
             context.bot.answer_callback_query(update.callback_query.id),
             context.bot.send_message(
@@ -294,26 +372,30 @@ async def processing_cbq(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # 'Parsing'
-    splitted = update.callback_query.data.split("§")
-    operation, from_user_chat_id, target_chat_id_str, target_chat_url = (
-        splitted[0],
-        splitted[1],
-        splitted[2],
-        splitted[3],
-    )
+    operation = callback.operation
+    if operation.startswith("digest-"):
+        return await processing_digest(update, context, callback)
+    if operation == "status-page":
+        return await paging_status(update, context, callback)
 
     # Auto mode
     if operation == "self-confirm":
+        from_user_chat_id, target_chat_id = callback.args
+        settings = await fetch_settings(target_chat_id)
+        target_chat_url = (
+            settings.chat_url
+            if settings and settings.chat_url
+            else ctx.strings["chat"]["url"]
+        )
         await gather(
             context.bot.answer_callback_query(update.callback_query.id),
             context.bot.send_message(
                 from_user_chat_id,
-                f"Thanks, you are welcome to join {target_chat_url}. {strings['has_joined']['post_join']}",
+                f"Thanks, you are welcome to join {target_chat_url}. {ctx.strings['has_joined']['post_join']}",
                 disable_web_page_preview=True,
             ),
             context.bot.approve_chat_join_request(
-                target_chat_id_str, update.callback_query.from_user.id
+                target_chat_id, update.callback_query.from_user.id
             ),
             log(
                 UserLog(
@@ -329,9 +411,8 @@ async def processing_cbq(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Manual or questionnaire mode
     # Setting up verdict handling
-    user_id_str, user_name = splitted[3], splitted[4]
-    user_id = int(user_id_str)
-    chat_id = int(target_chat_id_str)
+    chat_id, user_id = callback.args
+    user_name = callback.text or str(user_id)
     confirmation_chat_id = update.callback_query.message.chat.id
     admin_name = (
         update.callback_query.from_user.username
@@ -346,16 +427,14 @@ async def processing_cbq(update: Update, context: ContextTypes.DEFAULT_TYPE):
         case "accept":
             response = await context.bot.approve_chat_join_request(chat_id, user_id)
             if response:
-                reply = f"{user_name} accepted to {target_chat_id_str} by {admin_name}"
+                reply = f"{user_name} accepted to {chat_id} by {admin_name}"
             else:
                 reply = "User already approved"
 
         case "reject":
             response = await context.bot.decline_chat_join_request(chat_id, user_id)
             if response:
-                reply = (
-                    f"{user_name} denied access to {target_chat_id_str} by {admin_name}"
-                )
+                reply = f"{user_name} denied access to {chat_id} by {admin_name}"
             else:
                 reply = "User already denied."
         case _:
@@ -375,6 +454,96 @@ async def processing_cbq(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+async def processing_digest(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback
+):
+    cbq = update.callback_query
+    operation, digest_id = callback.operation, callback.args[0]
+    admin_name = cbq.from_user.username or cbq.from_user.first_name
+    notice = ""
+
+    match operation:
+        case "digest-page":
+            digest = await set_digest_page(digest_id, callback.args[1])
+
+        case "digest-accept" | "digest-reject":
+            user_id = callback.args[1]
+            if digest := await pull_from_digest(digest_id, user_id):
+                verdict = (
+                    context.bot.approve_chat_join_request
+                    if operation == "digest-accept"
+                    else context.bot.decline_chat_join_request
+                )
+                done = await mark_successful_coroutines(
+                    True, verdict(digest["chat_id"], user_id)
+                )
+                notice = (
+                    f"{'Accepted' if operation == 'digest-accept' else 'Rejected'} by {admin_name}"
+                    if done
+                    else "This request was already handled"
+                )
+                if not digest["users"]:
+                    await gather(
+                        remove_digest(digest_id),
+                        context.bot.delete_message(
+                            digest["destination"], digest["message_id"]
+                        ),
+                        context.bot.answer_callback_query(cbq.id, notice),
+                    )
+                    return
+
+        case "digest-accept-all" | "digest-reject-all":
+            if digest := await remove_digest(digest_id):
+                accepting = operation == "digest-accept-all"
+                verdict = (
+                    context.bot.approve_chat_join_request
+                    if accepting
+                    else context.bot.decline_chat_join_request
+                )
+                done = await gather(
+                    *[
+                        mark_successful_coroutines(
+                            u["user_id"],
+                            verdict(
+                                digest["chat_id"], u["user_id"], rate_limit_args=BULK
+                            ),
+                        )
+                        for u in digest["users"]
+                    ]
+                )
+                summary = f"{len([d for d in done if d])} users {'accepted to' if accepting else 'denied access to'} {mention_markdown(digest['chat_id'], digest['chat_name'])} by {admin_name}"
+                await gather(
+                    context.bot.edit_message_text(
+                        summary,
+                        digest["destination"],
+                        digest["message_id"],
+                        parse_mode=ParseMode.MARKDOWN,
+                    ),
+                    context.bot.answer_callback_query(cbq.id),
+                )
+                return
+
+        case _:
+            digest = None
+
+    if not digest:
+        await context.bot.answer_callback_query(cbq.id, "Already handled")
+        return
+
+    text, keyboard = digest_page(digest)
+    await gather(
+        context.bot.edit_message_text(
+            text,
+            digest["destination"],
+            digest["message_id"],
+            parse_mode=ParseMode.MARKDOWN,
+            disable_web_page_preview=True,
+            reply_markup=keyboard,
+        ),
+        context.bot.answer_callback_query(cbq.id, notice or None),
+    )
+
+
 async def has_joined(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     new_members = [
@@ -398,9 +567,11 @@ async def has_joined(update: Update, context: ContextTypes.DEFAULT_TYPE):
         report = ""
 
         if settings and getattr(settings, "helper_chat_id"):
-            report = f"{strings['has_joined']['destination']} {settings.helper_chat_id}"
+            report = (
+                f"{ctx.strings['has_joined']['destination']} {settings.helper_chat_id}"
+            )
         else:
-            report = strings["has_joined"]["not_destination"]
+            report = ctx.strings["has_joined"]["not_destination"]
 
         await context.bot.send_message(
             settings.helper_chat_id
@@ -436,8 +607,8 @@ async def has_joined(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         greet = (
             lambda lang: "welcome"
-            if not lang in strings["welcome"]
-            else strings["welcome"][lang]
+            if not lang in ctx.strings["welcome"]
+            else ctx.strings["welcome"][lang]
         )
         greetings = (
             ", ".join(
@@ -472,11 +643,25 @@ async def has_joined(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+async def tracking_admins(update: Update, _: ContextTypes.DEFAULT_TYPE):
+    member_update = update.chat_member or update.my_chat_member
+    if not member_update:
+        return
+
+    # Any change involving an administrator, the bot included, makes the cached admins stale
+    admin_statuses = {ChatMember.ADMINISTRATOR, ChatMember.OWNER}
+    if (
+        member_update.old_chat_member.status in admin_statuses
+        or member_update.new_chat_member.status in admin_statuses
+    ):
+        admins_cache.invalidate(member_update.chat.id)
+
+
 async def admin_op(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id, admin_id = update.message.chat.id, update.message.from_user.id
 
     if environ["ADMIN"] != str(admin_id):
-        return await context.bot.send_message(chat_id, strings["admin"]["error"])
+        return await context.bot.send_message(chat_id, ctx.strings["admin"]["error"])
 
     # Get all chats_ids
     _, msg = update.message.text.split(" ", maxsplit=1)
@@ -485,49 +670,142 @@ async def admin_op(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Broadcast, removing chats_ids that didn't accept the message
     failures = await gather(
         *[
-            mark_excepted_coroutines(cid, context.bot.send_message(cid, msg))
+            mark_excepted_coroutines(
+                cid, context.bot.send_message(cid, msg, rate_limit_args=BULK)
+            )
             for cid in chat_ids
         ]
     )
     await remove_chats([f for f in failures if f is not None])
 
 
+async def dropping_duplicates(update: Update, _: ContextTypes.DEFAULT_TYPE):
+    # Telegram delivers an update again when the webhook was slow to answer: only the first delivery goes through.
+    # Several workers may each get a delivery, the database tells which one came first
+    if recent_updates.fetch(update.update_id) or (
+        workers > 1 and not await claim_update(update.update_id)
+    ):
+        duplicate_updates.inc()
+        raise ApplicationHandlerStop
+    recent_updates.put(update.update_id, True)
+
+
 async def expected_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     text = update.message.text
 
-    if "/cancel" in text:
-        dialog_manager.cancel(user_id)
-        user_id = update.message.from_user.id
-        reply = "Okay, starting over"
-        return await context.bot.send_message(user_id, reply)
+    # Serialising the user's updates across workers when dialogs are shared
+    async with ctx.dialog_manager.lock(user_id):
+        dialog = await ctx.dialog_manager.fetch(user_id)
+        if not dialog:
+            # Nothing expected from this user, leaving the update to the other handlers
+            return
+
+        if "/cancel" in text:
+            if isinstance(dialog, Dialog):
+                ctx.dialog_manager.cancel(user_id)
+                await gather(
+                    ctx.dialog_manager.save(user_id),
+                    remove_answers(user_id, dialog.for_chat_id),
+                )
+            else:
+                await ctx.dialog_manager.drop(user_id)
+            reply = "Okay, starting over"
+            await context.bot.send_message(user_id, reply)
+            raise ApplicationHandlerStop
 
-    if dialog := dialog_manager[user_id]:
         match dialog:
             case Dialog():
-                if reply := dialog.take_reply(text):
+                # Restored from the store, without its extractor
+                if not dialog.extractor:
+                    dialog.extractor = questionnaire_extractor(context, dialog)
+
+                # Stored before being counted: the report is built from the stored answers
+                if text and not dialog.done:
+                    await save_answer(
+                        user_id, dialog.for_chat_id, dialog.answered, text
+                    )
+                reply = dialog.take_reply(text)
+                if dialog.done:
+                    await ctx.dialog_manager.drop(user_id)
+                else:
+                    await ctx.dialog_manager.save(user_id)
+                if reply:
                     await context.bot.send_message(user_id, reply)
-                elif dialog.done:
-                    dialog_manager.remove(user_id)
 
             case Reply():
-                await dialog.extractor(text)
-                dialog_manager.remove(user_id)
+                extractor = dialog.extractor or settings_extractor(
+                    context, dialog.chat_id
+                )
+                await extractor(text)
+                await ctx.dialog_manager.drop(user_id)
 
+    raise ApplicationHandlerStop
 
-@withAuth
-async def getting_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.message.chat.id
-    reply = ""
 
+async def expire_idle_dialogs(bot: Bot, user_ids: list[UserId]):
+    # Called with the conversations left untouched for DIALOG_IDLE_TIMEOUT seconds
+    for user_id in user_ids:
+        try:
+            async with ctx.dialog_manager.lock(user_id):
+                dialog = await ctx.dialog_manager.expire(user_id)
+            if not isinstance(dialog, Dialog):
+                continue
+            await remove_answers(user_id, dialog.for_chat_id)
+            if notify_idle_dialogs:
+                await bot.send_message(user_id, ctx.strings["dialog"]["expired"])
+        except Exception as error:
+            print(f"Failed to expire the conversation with {user_id}: {error}")
+
+
+async def render_status(chat_id: ChatId) -> list[str]:
     if status := await get_status(chat_id):
-        reply += status.render()
+        reply = status.render()
     else:
-        reply += "No pending, banned or notified users for this chat!"
+        reply = "No pending, banned or notified users for this chat!"
+    return slice_on_n(reply, STATUS_PAGE_SIZE)
+
+
+def status_page(pages: list[str], page: int) -> tuple[str, bool] | None:
+    if 0 <= page < len(pages):
+        return f"({page + 1}/{len(pages)}) {pages[page]}", page + 1 < len(pages)
+
 
-    sliced = slice_on_n(reply)
-    t = len(sliced)
+@withAuth
+async def getting_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat.id
+    # Rendered once: the buttons page through the pages kept for this message
+    pages = await render_status(chat_id)
+    if rendered := status_page(pages, 0):
+        text, has_next = rendered
+        message = await context.bot.send_message(
+            chat_id, text, reply_markup=status_btns(chat_id, 0, has_next)
+        )
+        status_pages.put((chat_id, message.message_id), pages)
+
+
+async def paging_status(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback
+):
+    cbq = update.callback_query
+    chat_id, page = callback.args
+    key = (cbq.message.chat.id, cbq.message.message_id)
+    # Rendered again once expired, or when the message was sent by another worker
+    if not (pages := status_pages.fetch(key)):
+        pages = await render_status(chat_id)
+        status_pages.put(key, pages)
+
+    if not (rendered := status_page(pages, page)):
+        await context.bot.answer_callback_query(cbq.id, "No more pages")
+        return
 
-    for i, s in enumerate(sliced):
-        e = f"({i+1}/{t}) {s}"
-        await context.bot.send_message(chat_id, e)
+    text, has_next = rendered
+    await gather(
+        context.bot.edit_message_text(
+            text,
+            cbq.message.chat.id,
+            cbq.message.message_id,
+            reply_markup=status_btns(chat_id, page, has_next),
+        ),
+        context.bot.answer_callback_query(cbq.id),
+    )
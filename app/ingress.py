@@ -0,0 +1,144 @@
+import json
+from asyncio import Queue, QueueFull, Semaphore, Task
+from asyncio import TimeoutError as AsyncTimeoutError
+from asyncio import create_task, wait_for
+from http import HTTPStatus
+from re import escape
+from time import monotonic
+from typing import Optional
+
+from telegram import Update
+from telegram.ext import Application, ExtBot
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application as WebApplication
+from tornado.web import HTTPError, RequestHandler
+
+from app.metrics import ingress_updates, ingress_wait
+from app.processor import OrderedProcessor
+
+""" Webhook ingress answering Telegram right away, updates being processed off a bounded queue """
+
+
+class IngressHandler(RequestHandler):
+    """
+    Checks the request, queues its raw body and answers at once: Telegram never waits for the handlers.
+    A full queue is answered with a 503, for Telegram to send the update again later.
+    """
+
+    ingress: "Ingress"
+
+    def initialize(self, ingress: "Ingress"):
+        self.ingress = ingress
+
+    def post(self):
+        if self.request.headers.get("Content-Type") != "application/json":
+            ingress_updates.inc(outcome="invalid")
+            raise HTTPError(HTTPStatus.FORBIDDEN)
+        secret_token = self.ingress.secret_token
+        if (
+            secret_token
+            and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token")
+            != secret_token
+        ):
+            ingress_updates.inc(outcome="invalid")
+            raise HTTPError(HTTPStatus.FORBIDDEN)
+
+        try:
+            self.ingress.queue.put_nowait((monotonic(), self.request.body))
+        except QueueFull:
+            ingress_updates.inc(outcome="rejected")
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE)
+        ingress_updates.inc(outcome="accepted")
+
+    def log_exception(self, *args):
+        pass
+
+
+class Ingress:
+    """
+    Bounded queue of raw updates, and the consumer decoding them and handing them over to the OrderedProcessor.
+    The consumer does not wait for an update to be processed: one held up behind its chat or user leaves the other
+    chats flowing. Up to `max_pending` updates are handed over and not processed yet, beyond which the queue fills up,
+    rather than memory, when the handlers fall behind.
+    """
+
+    app: Application
+    processor: OrderedProcessor
+    queue: Queue[tuple[float, bytes]]
+    max_pending: int
+    pending: Semaphore
+    secret_token: Optional[str]
+    task: Optional[Task]
+    server: Optional[HTTPServer]
+
+    def __init__(
+        self,
+        app: Application,
+        processor: OrderedProcessor,
+        max_size: int = 10_000,
+        max_pending: int = 256,
+        secret_token: Optional[str] = None,
+    ):
+        self.app = app
+        self.processor = processor
+        self.queue = Queue(max_size)
+        self.max_pending = max_pending
+        self.pending = Semaphore(max_pending)
+        self.secret_token = secret_token
+        self.task = None
+        self.server = None
+
+    def __len__(self) -> int:
+        return self.queue.qsize()
+
+    def decode(self, body: bytes) -> Optional[Update]:
+        try:
+            update = Update.de_json(json.loads(body), self.app.bot)
+        except Exception as error:
+            print(f"Ingress: dropped an update that could not be decoded: {error}")
+            return None
+        if update and isinstance(self.app.bot, ExtBot):
+            self.app.bot.insert_callback_data(update)
+        return update
+
+    async def _consume(self):
+        # A single consumer: updates are submitted in arrival order
+        while True:
+            await self.pending.acquire()
+            queued_at, body = await self.queue.get()
+            ingress_wait.observe(monotonic() - queued_at)
+            if update := self.decode(body):
+                task = self.processor.submit(update, self.app.process_update)
+                task.add_done_callback(self._processed)
+            else:
+                self._processed()
+
+    def _processed(self, _: Optional[Task] = None):
+        self.pending.release()
+        self.queue.task_done()
+
+    def start(
+        self, port: int, url_path: str, ssl_options: Optional[dict] = None
+    ) -> int:
+        # Returns the port listened on, picked by the system when `port` is 0
+        self.task = create_task(self._consume())
+        routes = [
+            (rf"/{escape(url_path.strip('/'))}/?", IngressHandler, {"ingress": self})
+        ]
+        sockets = bind_sockets(port)
+        self.server = HTTPServer(WebApplication(routes), ssl_options=ssl_options)
+        self.server.add_sockets(sockets)
+        return sockets[0].getsockname()[1]
+
+    async def stop(self, timeout: float = 30):
+        # No more updates taken in, the ones already accepted are processed before leaving
+        if self.server:
+            self.server.stop()
+        try:
+            await wait_for(self.queue.join(), timeout)
+        except AsyncTimeoutError:
+            print(f"Ingress: {len(self)} updates left unprocessed on shutdown")
+        if self.task:
+            self.task.cancel()
+            self.task = None
@@ -0,0 +1,77 @@
+from asyncio import sleep
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import DuplicateKeyError
+
+
+class Lease:
+    """
+    Named lease stored in Mongo. At most one holder at a time; a lease not renewed
+    within `ttl` can be taken over by anyone else.
+    """
+
+    collection: AsyncIOMotorCollection
+    name: str
+    holder: str
+    ttl: timedelta
+
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        name: str,
+        holder: str,
+        ttl: timedelta = timedelta(seconds=30),
+    ):
+        self.collection = collection
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+
+    async def acquire(self) -> bool:
+        # Also renews the lease when already held. In UTC, as MongoDB's TTL monitor reads `expires_at`
+        now = datetime.now(timezone.utc)
+        try:
+            await self.collection.find_one_and_update(
+                {
+                    "_id": self.name,
+                    "$or": [{"holder": self.holder}, {"expires_at": {"$lt": now}}],
+                },
+                {"$set": {"holder": self.holder, "expires_at": now + self.ttl}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            # The lease exists and is held by someone else
+            return False
+
+    async def release(self):
+        await self.collection.delete_one({"_id": self.name, "holder": self.holder})
+
+
+@asynccontextmanager
+async def holding(lease: Lease, timeout: float = 10) -> AsyncIterator[None]:
+    waited = 0.0
+    while not await lease.acquire():
+        if waited >= timeout:
+            raise TimeoutError(f"Unable to acquire {lease.name} within {timeout}s")
+        await sleep(0.05)
+        waited += 0.05
+    try:
+        yield
+    finally:
+        await lease.release()
+
+
+async def heartbeat(lease: Lease, every: float | None = None):
+    # Renews the lease until cancelled, by default three times per ttl
+    every = every or lease.ttl.total_seconds() / 3
+    while True:
+        try:
+            if not await lease.acquire():
+                print(f"Lease {lease.name} is held by another instance")
+        except Exception as error:
+            print(f"Lease {lease.name} could not be renewed: {error}")
+        await sleep(every)
@@ -0,0 +1,239 @@
+from functools import wraps
+from threading import Lock
+from time import monotonic
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from pymongo.monitoring import (
+    CommandFailedEvent,
+    CommandListener,
+    CommandStartedEvent,
+    CommandSucceededEvent,
+)
+from telegram.ext import ApplicationHandlerStop
+from tornado.web import Application, RequestHandler
+
+""" Metrics in the Prometheus text format. Updates may come from Motor's threads, hence the locks """
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Metric:
+    name: str
+    help: str
+    kind: str
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = Lock()
+        registry.append(self)
+
+    def samples(self) -> list[str]:
+        ...
+
+    def render(self) -> str:
+        return "\n".join(
+            [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+            + self.samples()
+        )
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [
+                f"{self.name}{_format(key)} {value}"
+                for key, value in self.values.items()
+            ]
+
+
+class Gauge(Metric):
+    """
+    Either set explicitly, or read from `read` at scrape time
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self, name: str, help: str, read: Optional[Callable[[], float]] = None
+    ):
+        super().__init__(name, help)
+        self.values: dict[Labels, float] = {}
+        self.read = read
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.values[_labels(labels)] = value
+
+    def samples(self) -> list[str]:
+        if self.read:
+            return [f"{self.name} {self.read()}"]
+        with self._lock:
+            return [
+                f"{self.name}{_format(key)} {value}"
+                for key, value in self.values.items()
+            ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+        # Per set of labels: count per bucket (not cumulative), sum and count
+        self.values: dict[Labels, tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        with self._lock:
+            counts, total, n = self.values.get(key) or ([0] * len(self.buckets), 0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = counts, total + value, n + 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total, n) in self.values.items():
+                cumulated = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulated += count
+                    le = _format(key + (("le", str(bound)),))
+                    lines.append(f"{self.name}_bucket{le} {cumulated}")
+                lines.append(
+                    f'{self.name}_bucket{_format(key + (("le", "+Inf"),))} {n}'
+                )
+                lines.append(f"{self.name}_sum{_format(key)} {total}")
+                lines.append(f"{self.name}_count{_format(key)} {n}")
+        return lines
+
+
+registry: list[Metric] = []
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+""" Instruments """
+
+handler_latency = Histogram(
+    "ringo_handler_latency_seconds", "Time spent in update handlers"
+)
+handler_errors = Counter("ringo_handler_errors_total", "Update handlers that raised")
+mongo_latency = Histogram(
+    "ringo_mongo_latency_seconds", "MongoDB commands round-trip time"
+)
+mongo_errors = Counter("ringo_mongo_errors_total", "MongoDB commands that failed")
+bot_api_latency = Histogram("ringo_bot_api_latency_seconds", "Bot API calls latency")
+bot_api_errors = Counter("ringo_bot_api_errors_total", "Bot API calls that failed")
+sweep_duration = Histogram(
+    "ringo_sweep_duration_seconds",
+    "Background sweep duration",
+    buckets=DURATION_BUCKETS,
+)
+sweep_items = Gauge("ringo_sweep_items", "Items processed by the last background sweep")
+duplicate_updates = Counter(
+    "ringo_duplicate_updates_total", "Updates delivered again by Telegram, dropped"
+)
+ingress_updates = Counter(
+    "ringo_ingress_updates_total",
+    "Webhook requests to the ingress, by outcome: accepted, rejected (queue full) or invalid",
+)
+ingress_wait = Histogram(
+    "ringo_ingress_wait_seconds", "Time updates spent in the ingress queue"
+)
+
+T = TypeVar("T")
+
+
+def timed(callback: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    # Records the latency of an update handler under its name
+    name = callback.__name__
+
+    @wraps(callback)
+    async def wrapper(*args, **kwargs) -> T:
+        started = monotonic()
+        try:
+            return await callback(*args, **kwargs)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            handler_latency.observe(monotonic() - started, handler=name)
+
+    return wrapper
+
+
+class MongoTimings(CommandListener):
+    """
+    Times every command sent by the driver, by collection and command name
+    """
+
+    def __init__(self):
+        self.pending: dict[tuple[Any, int], tuple[str, str]] = {}
+
+    def started(self, event: CommandStartedEvent):
+        name = event.command_name
+        target = event.command.get(name)
+        collection = event.command.get("collection") if name == "getMore" else target
+        if isinstance(collection, str):
+            self.pending[(event.connection_id, event.request_id)] = collection, name
+
+    def succeeded(self, event: CommandSucceededEvent):
+        if command := self.pending.pop((event.connection_id, event.request_id), None):
+            collection, name = command
+            mongo_latency.observe(
+                event.duration_micros / 1e6, collection=collection, command=name
+            )
+
+    def failed(self, event: CommandFailedEvent):
+        if command := self.pending.pop((event.connection_id, event.request_id), None):
+            collection, name = command
+            mongo_latency.observe(
+                event.duration_micros / 1e6, collection=collection, command=name
+            )
+            mongo_errors.inc(collection=collection, command=name)
+
+
+class MetricsHandler(RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(render())
+
+
+def serve_metrics(port: int):
+    Application([(r"/metrics", MetricsHandler)]).listen(port)
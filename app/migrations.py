@@ -0,0 +1,19 @@
+"""
+One-off database migrations. Run with `python -m app.migrations`.
+"""
+
+from asyncio import run
+
+from app.db import ensure_indexes, migrate_answers, migrate_pending
+
+
+async def main():
+    await ensure_indexes()
+    moved = await migrate_pending()
+    print(f"Moved {moved} pending requests out of the chats collection")
+    moved = await migrate_answers()
+    print(f"Moved the answers of {moved} questionnaires out of the dialogs collection")
+
+
+if __name__ == "__main__":
+    run(main())
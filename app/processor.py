@@ -0,0 +1,108 @@
+from asyncio import BoundedSemaphore, Task, create_task, wait
+from typing import Any, Awaitable, Callable, Hashable
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.ext._application import _STOP_SIGNAL
+
+""" Concurrent processing of updates, ordered per chat and per user """
+
+
+def ordering_keys(update: object) -> list[Hashable]:
+    # Updates of the same chat, or from the same user, are processed in arrival order
+    if not isinstance(update, Update):
+        return []
+    keys: list[Hashable] = []
+    if chat := update.effective_chat:
+        keys.append(("chat", chat.id))
+    if user := update.effective_user:
+        keys.append(("user", user.id))
+    return keys
+
+
+class OrderedProcessor:
+    """
+    Processes updates concurrently, at most `limit` at a time, while updates sharing a key are processed one after the
+    other, in submission order. An update waits for the previous one of each of its keys before taking a slot,
+    so that a busy chat never holds slots the other chats could use.
+    """
+
+    limit: int
+    keys: Callable[[Any], list[Hashable]]
+    semaphore: BoundedSemaphore
+    # Last update submitted per key, the next one waits for it
+    tails: dict[Hashable, Task]
+    waiting: int
+    running: int
+
+    def __init__(
+        self, limit: int = 32, keys: Callable[[Any], list[Hashable]] = ordering_keys
+    ):
+        self.limit = limit
+        self.keys = keys
+        self.semaphore = BoundedSemaphore(limit)
+        self.tails = {}
+        self.waiting = 0
+        self.running = 0
+
+    def submit(self, update: Any, process: Callable[[Any], Awaitable[Any]]) -> Task:
+        keys = self.keys(update)
+        previous = {self.tails[key] for key in keys if key in self.tails}
+        task = create_task(self._process(update, process, previous))
+        for key in keys:
+            self.tails[key] = task
+        task.add_done_callback(lambda _: self._forget(keys, task))
+        return task
+
+    async def _process(
+        self, update: Any, process: Callable[[Any], Awaitable[Any]], previous: set[Task]
+    ):
+        self.waiting += 1
+        try:
+            if previous:
+                await wait(previous)
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        try:
+            await process(update)
+        except Exception as error:
+            print(f"OrderedProcessor: failed to process {update}: {error}")
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+
+    def _forget(self, keys: list[Hashable], task: Task):
+        for key in keys:
+            if self.tails.get(key) is task:
+                del self.tails[key]
+
+
+class OrderedApplication(Application):
+    """
+    Application handing its updates over to an OrderedProcessor, rather than processing them one at a time
+    or concurrently without any ordering. PTB 20.2 has no public hook for this (BaseUpdateProcessor comes with 20.4).
+    """
+
+    processor: OrderedProcessor
+
+    def __init__(self, processor: OrderedProcessor, **kwargs):
+        super().__init__(**kwargs)
+        self.processor = processor
+
+    async def _update_fetcher(self):
+        while True:
+            update = await self.update_queue.get()
+            if update is _STOP_SIGNAL:
+                # As PTB does: whatever is left in the queue is dropped
+                while not self.update_queue.empty():
+                    self.update_queue.get_nowait()
+                    self.update_queue.task_done()
+                self.update_queue.task_done()
+                return
+
+            # Stopping waits for the queue to be joined, that is for every update to be processed
+            task = self.processor.submit(update, self.process_update)
+            task.add_done_callback(lambda _: self.update_queue.task_done())
@@ -0,0 +1,152 @@
+from asyncio import Future, Task, create_task, get_running_loop, sleep
+from heapq import heappop, heappush
+from itertools import count
+from time import monotonic
+from typing import Any, Callable, Coroutine, Optional
+
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+
+from app.cache import TTLCache
+from app.metrics import bot_api_errors, bot_api_latency
+
+""" Priorities, lowest first. Pass as `rate_limit_args` to any bot method """
+INTERACTIVE = {"priority": 0}
+BULK = {"priority": 10}
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens per second, up to `capacity`.
+    Waiters are served by priority, then in order of arrival.
+    """
+
+    rate: float
+    capacity: float
+    tokens: float
+    waiters: list[tuple[int, int, Future]]
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.waiters = []
+        self._updated_at = monotonic()
+        self._seq = count()
+        self._drainer: Optional[Task] = None
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    async def acquire(self, priority: int = 0):
+        self._refill()
+        if not self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+
+        waiter = get_running_loop().create_future()
+        heappush(self.waiters, (priority, next(self._seq), waiter))
+        if not self._drainer or self._drainer.done():
+            self._drainer = create_task(self._drain())
+        await waiter
+
+    async def _drain(self):
+        while self.waiters:
+            self._refill()
+            if self.tokens >= 1:
+                _, _, waiter = heappop(self.waiters)
+                # Skipping waiters whose caller was cancelled
+                if not waiter.done():
+                    self.tokens -= 1
+                    waiter.set_result(None)
+            else:
+                await sleep((1 - self.tokens) / self.rate)
+
+
+class OutboundLimiter(BaseRateLimiter[dict]):
+    """
+    Funnels every Bot API call through a global token bucket, and messages through per-chat buckets as well.
+    Calls failing with RetryAfter pause all outbound traffic for the requested time, then are retried.
+    """
+
+    overall: TokenBucket
+    per_chat: TTLCache
+    per_chat_rate: float
+    per_chat_burst: float
+    max_retries: int
+    paused_until: float
+    retries: int
+
+    def __init__(
+        self,
+        overall_rate: float = 30,
+        per_chat_rate: float = 1,
+        per_chat_burst: float = 3,
+        max_retries: int = 3,
+    ):
+        self.overall = TokenBucket(overall_rate, overall_rate)
+        self.per_chat = TTLCache(max_size=10000, ttl=60)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self.paused_until = 0
+        self.retries = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        if not (bucket := self.per_chat.fetch(chat_id)):
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        # Refreshing the entry so that buckets of active chats are not evicted
+        self.per_chat.put(chat_id, bucket)
+        return bucket
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, bool | dict | list[dict]]],
+        args: Any,
+        kwargs: dict[str, Any],
+        endpoint: str,
+        data: dict[str, Any],
+        rate_limit_args: Optional[dict],
+    ) -> bool | dict | list[dict]:
+        priority = (rate_limit_args or INTERACTIVE)["priority"]
+        chat_id = data.get("chat_id")
+        is_message = endpoint.startswith("send") or endpoint in {
+            "copyMessage",
+            "forwardMessage",
+        }
+        attempt = 0
+
+        while True:
+            if (pause := self.paused_until - monotonic()) > 0:
+                await sleep(pause)
+            if is_message and chat_id is not None:
+                await self._chat_bucket(chat_id).acquire(priority)
+            await self.overall.acquire(priority)
+
+            started = monotonic()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as error:
+                bot_api_errors.inc(endpoint=endpoint, error="RetryAfter")
+                attempt += 1
+                self.retries += 1
+                if attempt > self.max_retries:
+                    raise
+                self.paused_until = max(
+                    self.paused_until, monotonic() + error.retry_after
+                )
+            except TelegramError as error:
+                bot_api_errors.inc(endpoint=endpoint, error=type(error).__name__)
+                raise
+            finally:
+                bot_api_latency.observe(monotonic() - started, endpoint=endpoint)
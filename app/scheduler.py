@@ -0,0 +1,95 @@
+from asyncio import Event, Task, TimeoutError, create_task, wait_for
+from datetime import datetime, timedelta
+from heapq import heappop, heappush
+from itertools import count
+from typing import Any, Callable, Coroutine, Literal, NamedTuple, Optional, TypeAlias
+
+from app.types import User
+
+REMIND_AFTER = timedelta(minutes=20)
+EXPIRE_AFTER = timedelta(hours=6)
+SWEEP_EVERY = timedelta(hours=1)
+
+DeadlineKind = Literal["remind", "expire", "sweep"]
+OnDue: TypeAlias = Callable[[DeadlineKind, list[User]], Coroutine[Any, Any, None]]
+
+
+class Deadline(NamedTuple):
+    at: datetime
+    seq: int
+    kind: DeadlineKind
+    user: Optional[User]
+
+
+class Scheduler:
+    """
+    Holds the deadlines of join requests in a min-heap. A single task sleeps until the earliest
+    deadline comes due and hands over every due deadline, grouped by kind, to the `on_due` callback.
+    """
+
+    heap: list[Deadline]
+    on_due: Optional[OnDue]
+    task: Optional[Task]
+
+    def __init__(self):
+        self.heap = []
+        self.on_due = None
+        self.task = None
+        self._seq = count()
+        self._wakeup = Event()
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def schedule(self, at: datetime, kind: DeadlineKind, user: Optional[User] = None):
+        deadline = Deadline(at, next(self._seq), kind, user)
+        heappush(self.heap, deadline)
+
+        # Only an earlier deadline changes how long the runner should sleep
+        if self.heap[0] is deadline:
+            self._wakeup.set()
+
+    def register(self, user: User, at: Optional[datetime] = None):
+        # Follow-ups of a join request landed at `at`
+        at = at or datetime.now()
+        self.schedule(at + REMIND_AFTER, "remind", user)
+        self.schedule(at + EXPIRE_AFTER, "expire", user)
+
+    def pop_due(self, now: datetime) -> dict[DeadlineKind, list[User]]:
+        due: dict[DeadlineKind, list[User]] = {}
+        while self.heap and self.heap[0].at <= now:
+            deadline = heappop(self.heap)
+            users = due.setdefault(deadline.kind, [])
+            if deadline.user:
+                users.append(deadline.user)
+        return due
+
+    def start(self, on_due: OnDue):
+        self.on_due = on_due
+        if not self.task:
+            self.task = create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+
+            for kind, users in self.pop_due(datetime.now()).items():
+                try:
+                    await self.on_due(kind, users)
+                except Exception as error:
+                    print(f"Scheduler: failed to process {kind} deadlines: {error}")
+
+            timeout = (
+                max((self.heap[0].at - datetime.now()).total_seconds(), 0)
+                if self.heap
+                else None
+            )
+            try:
+                await wait_for(self._wakeup.wait(), timeout)
+            except TimeoutError:
+                pass
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+from asyncio import to_thread
+from threading import Lock
+from typing import TYPE_CHECKING, Any, Callable, Protocol
+
+if TYPE_CHECKING:
+    from motor.motor_asyncio import AsyncIOMotorCollection
+
+""" Persistent backends for the DialogManager """
+
+
+class DialogStore(Protocol):
+    async def load(self, user_id: Any) -> dict | None:
+        ...
+
+    async def save(self, user_id: Any, doc: dict) -> None:
+        ...
+
+    async def delete(self, user_id: Any) -> None:
+        ...
+
+    async def keys(self) -> list[Any]:
+        ...
+
+
+class MongoDialogStore:
+    """
+    One document per user, shared by every instance using the same database
+    """
+
+    collection: AsyncIOMotorCollection
+
+    def __init__(self, collection: AsyncIOMotorCollection):
+        self.collection = collection
+
+    async def load(self, user_id: Any) -> dict | None:
+        return await self.collection.find_one({"_id": user_id}, projection={"_id": 0})
+
+    async def save(self, user_id: Any, doc: dict) -> None:
+        await self.collection.replace_one({"_id": user_id}, doc, upsert=True)
+
+    async def delete(self, user_id: Any) -> None:
+        await self.collection.delete_one({"_id": user_id})
+
+    async def keys(self) -> list[Any]:
+        return [doc["_id"] async for doc in self.collection.find({}, {"_id": 1})]
+
+
+class SQLiteDialogStore:
+    """
+    Embedded store for single-node setups. Documents are kept as JSON in a local SQLite file.
+    Queries run in a worker thread, one at a time, so that the event loop never waits on the disk.
+    """
+
+    connection: sqlite3.Connection
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS dialogs (user_id TEXT PRIMARY KEY, doc TEXT NOT NULL)"
+        )
+        self._lock = Lock()
+
+    async def _run(self, query: Callable[[sqlite3.Connection], Any]) -> Any:
+        def locked():
+            with self._lock:
+                return query(self.connection)
+
+        return await to_thread(locked)
+
+    async def load(self, user_id: Any) -> dict | None:
+        row = await self._run(
+            lambda connection: connection.execute(
+                "SELECT doc FROM dialogs WHERE user_id = ?", (str(user_id),)
+            ).fetchone()
+        )
+        if row:
+            return json.loads(row[0])
+
+    async def save(self, user_id: Any, doc: dict) -> None:
+        def save(connection: sqlite3.Connection):
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO dialogs (user_id, doc) VALUES (?, ?)",
+                    (str(user_id), json.dumps(doc)),
+                )
+
+        await self._run(save)
+
+    async def delete(self, user_id: Any) -> None:
+        def delete(connection: sqlite3.Connection):
+            with connection:
+                connection.execute(
+                    "DELETE FROM dialogs WHERE user_id = ?", (str(user_id),)
+                )
+
+        await self._run(delete)
+
+    async def keys(self) -> list[Any]:
+        rows = await self._run(
+            lambda connection: connection.execute(
+                "SELECT user_id FROM dialogs"
+            ).fetchall()
+        )
+        return [
+            int(user_id) if user_id.lstrip("-").isdigit() else user_id
+            for (user_id,) in rows
+        ]
@@ -1,14 +1,17 @@
 from __future__ import annotations
 
-from asyncio import create_task, get_running_loop
+from asyncio import Lock, Task, create_task, get_running_loop, sleep
+from contextlib import asynccontextmanager, nullcontext
 from datetime import datetime
-from functools import reduce
 from itertools import pairwise
+from time import time
 from typing import (
     Any,
+    AsyncContextManager,
+    AsyncIterator,
+    Awaitable,
     Callable,
     Coroutine,
-    Iterator,
     Literal,
     NamedTuple,
     Optional,
@@ -19,6 +22,9 @@ from typing import (
 from telegram import Update
 from telegram.helpers import escape_markdown
 
+from app.store import DialogStore
+from app.wheel import TimingWheel
+
 ChatId: TypeAlias = int | str
 UserId: TypeAlias = int | str
 MessageId: TypeAlias = int | str
@@ -53,6 +59,9 @@ Settings_boolean_keys = {
 
 Mode = Literal["auto", "manual", "questionnaire"]
 
+# Settings keys never change, no need to escape them on every render
+escaped_keys = {k: escape_markdown(k) for k in Settings_keys}
+
 
 class Questionnaire(NamedTuple):
     intro: str
@@ -134,8 +143,6 @@ class Settings(AsDict):
         return nones + missing
 
     def render(self, with_alert: bool = True) -> str:
-        d = self.as_dict()
-
         def pretty_bool_str(v: Any) -> str:
             match v:
                 case Questionnaire():
@@ -147,31 +154,20 @@ class Settings(AsDict):
                 case _:
                     return v if isinstance(v, str) else str(v)
 
-        if with_alert:
-
-            def reducer(acc, item) -> str:
-                k, v = item[0], item[1]
-
-                if k in ["chat_url", "verification_msg"] and (not v or v == "None"):
-                    return (
-                        acc
-                        + "\n"
-                        + b"\xE2\x9A\xA0".decode("utf-8")
-                        + f"Missing an important value here ({escape_markdown(k)})! The bot won't be able to operate properly without it!\n\n"
-                    )
+        def line(k: str, v: Any) -> str:
+            if (
+                with_alert
+                and k in ["chat_url", "verification_msg"]
+                and (not v or v == "None")
+            ):
                 return (
-                    acc
-                    + f"{escape_markdown(k)}: {escape_markdown(pretty_bool_str(v))}\n"
+                    "\n"
+                    + b"\xE2\x9A\xA0".decode("utf-8")
+                    + f"Missing an important value here ({escaped_keys[k]})! The bot won't be able to operate properly without it!\n\n"
                 )
+            return f"{escaped_keys.get(k) or escape_markdown(k)}: {escape_markdown(pretty_bool_str(v))}\n"
 
-            return reduce(reducer, d.items(), "")
-
-        else:
-            reducer = (
-                lambda acc, item: acc
-                + f"{escape_markdown(item[0])}: {escape_markdown(pretty_bool_str(item[1]))}\n"
-            )
-            return reduce(reducer, d.items(), "")
+        return "".join(line(k, v) for k, v in self.as_dict().items())
 
     def __len__(self) -> int:
         return len(self.as_dict())
@@ -281,6 +277,11 @@ class ServiceLog(AsDict):
 Log: TypeAlias = UserLog | ServiceLog
 
 
+class ChatAdmins(NamedTuple):
+    ids: frozenset[UserId]
+    mkup: str
+
+
 class User(NamedTuple):
     user_id: UserId
     chat_id: ChatId
@@ -291,24 +292,27 @@ class User(NamedTuple):
 
 """" Conversation handler to replace the garbage ConversationHandler from the library"""
 
-Extractor: TypeAlias = Callable[[list[str] | str], Coroutine[Any, Any, None]]
+# Called with the text of a reply, or without arguments once a questionnaire is answered
+Extractor: TypeAlias = Callable[..., Coroutine[Any, Any, None]]
 
 
 class Dialog:
     """
-    Holds a 1-1 conversation between the bot and users
+    Holds a 1-1 conversation between the bot and users. Answers are not kept here but stored
+    as they come (see `save_answer`), the dialog only counts them
     """
 
     user_id: UserId
+    user_name: str
     for_chat_id: ChatId
 
     intro: str
     questions: list[str]
     outro: str
 
-    answers: list[str]
-    it: Iterator[str]
-    extractor: Extractor
+    answered: int
+    position: int
+    extractor: Optional[Extractor]
     has_started: bool
 
     tasks = set()
@@ -318,53 +322,85 @@ class Dialog:
         user_id: UserId,
         chat_id: ChatId,
         q: Questionnaire,
-        extract_answers: Callable,
+        extract_answers: Optional[Callable],
+        user_name: str = "",
     ):
         self.user_id = user_id
+        self.user_name = user_name
         self.for_chat_id = chat_id
 
         self.intro = q.intro
         self.questions = q.questions
         self.outro = q.outro
 
-        self.answers = []
-        self.it = iter(self.questions)
+        self.answered = 0
+        # Number of questions asked so far
+        self.position = 0
         self.extractor = extract_answers
         self.has_started = False
 
     def _next_q(self, answer: Optional[str] = None) -> str | None:
-        try:
-            if answer:
-                self.answers.append(answer)
-            return next(self.it)
+        if answer:
+            self.answered += 1
 
-        except StopIteration:
-            return None
+        if self.position < len(self.questions):
+            self.position += 1
+            return self.questions[self.position - 1]
 
     @property
     def done(self) -> bool:
-        return len(self.answers) == len(self.questions)
+        return self.answered == len(self.questions)
 
     def start(self):
         self.has_started = True
 
     def start_over(self):
-        self.it = iter(self.questions)
-        self.answers = []
+        self.position = 0
+        self.answered = 0
+
+    def as_dict(self) -> dict:
+        # Everything but the extractor, which is rebuilt by the caller when loading the dialog
+        return {
+            "kind": "dialog",
+            "user_id": self.user_id,
+            "user_name": self.user_name,
+            "chat_id": self.for_chat_id,
+            "questionnaire": Questionnaire(
+                self.intro, self.questions, self.outro
+            )._asdict(),
+            "answered": self.answered,
+            "position": self.position,
+            "has_started": self.has_started,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> Dialog:
+        dialog = cls(
+            d["user_id"],
+            d["chat_id"],
+            Questionnaire(**d["questionnaire"]),
+            None,
+            d.get("user_name", ""),
+        )
+        # Dialogs saved before answers were stored apart held them, see `migrate_answers`
+        dialog.answered = d.get("answered", len(d.get("answers", [])))
+        dialog.position = d["position"]
+        dialog.has_started = d["has_started"]
+        return dialog
 
     def extract_answers(self):
         # Schedules async callback
         try:
             loop = get_running_loop()
-            if loop.is_running:
-                t = create_task(self.extractor(self.answers))
+            if loop.is_running and self.extractor:
+                t = create_task(self.extractor())
                 self.tasks.add(t)
                 t.add_done_callback(self.tasks.discard)
             else:
-                print(f"Mock extracting{self.answers}")
+                print(f"Mock extracting {self.answered} answers")
 
         except RuntimeError:
-            print(f"Mock extracting:{self.answers}")
+            print(f"Mock extracting {self.answered} answers")
 
     def take_reply(self, answer: Optional[str] = None) -> None | str:
         # Dialog has not begun yet
@@ -391,50 +427,105 @@ class Dialog:
 class Reply(NamedTuple):
     user_id: UserId
     chat_id: ChatId
-    extractor: Extractor
+    extractor: Optional[Extractor]
+
+    def as_dict(self) -> dict:
+        return {"kind": "reply", "user_id": self.user_id, "chat_id": self.chat_id}
 
 
 Interaction: TypeAlias = Reply | Dialog
 
 
+def load_interaction(d: dict) -> Interaction:
+    match d["kind"]:
+        case "dialog":
+            return Dialog.from_dict(d)
+        case _:
+            return Reply(d["user_id"], d["chat_id"], None)
+
+
 class DialogManager(OrderedDict):
     """
     Holds all the 1-1 conversations between the bot and users.
     We are intentionnally not allowing a single user
     to have two validation conversations at the same time.
+    Only the `max_size` most recently used conversations are kept in memory. With a store,
+    every conversation is also persisted there: evicted ones are reloaded on demand and survive restarts.
+    When `shared` with other workers, the store is the only source of truth and each user's
+    conversation is only handled under the lock returned by `locks`.
+    A conversation left untouched for `idle_timeout` seconds is handed over to the `on_idle` callback,
+    its timeout being kept in a timing wheel that a single task advances every tick.
     """
 
     max_size: int
+    store: Optional[DialogStore]
+    spilled: set[UserId]
+    shared: bool
+    locks: Optional[Callable[[UserId], AsyncContextManager]]
+    # Per user in this process, forgotten once nobody holds nor waits for them
+    user_locks: dict[UserId, Lock]
+    lock_users: dict[UserId, int]
+    idle_timeout: Optional[float]
+    wheel: TimingWheel
+    on_idle: Optional[Callable[[list[UserId]], Awaitable[Any]]]
+    task: Optional[Task]
 
-    def __init__(self, max_size=100):
+    def __init__(
+        self,
+        max_size=100,
+        store: Optional[DialogStore] = None,
+        shared: bool = False,
+        locks: Optional[Callable[[UserId], AsyncContextManager]] = None,
+        idle_timeout: Optional[float] = None,
+        wheel: Optional[TimingWheel] = None,
+    ):
         super().__init__()
         self.max_size = max_size
+        self.store = store
+        self.spilled = set()
+        self.shared = shared
+        self.locks = locks
+        self.user_locks = {}
+        self.lock_users = {}
+        self.idle_timeout = idle_timeout
+        self.wheel = wheel if wheel is not None else TimingWheel()
+        self.on_idle = None
+        self.task = None
 
     def __setitem__(self, user_id: UserId, interaction: Interaction):
-        while len(self) > self.max_size:
-            self.popitem(last=False)
-
         super().__setitem__(user_id, interaction)
         self.move_to_end(user_id)
+        self.touch(user_id)
+
+        while len(self) > self.max_size:
+            evicted, _ = self.popitem(last=False)
+            if self.store:
+                self.spilled.add(evicted)
 
     def __getitem__(self, user_id: UserId) -> None | Interaction:
         return super().get(user_id)
 
+    def __contains__(self, user_id: object) -> bool:
+        return super().__contains__(user_id) or user_id in self.spilled
+
     def add(
         self,
         user_id,
         interaction: Interaction,
     ):
+        self.spilled.discard(user_id)
         self.__setitem__(user_id, interaction)
         print(
-            f"DialogManager: Added {user_id}. Currently expecting {len(self)} users: {list(self.keys())}"
+            f"DialogManager: Added {user_id}. Currently expecting {len(self) + len(self.spilled)} users."
         )
 
     def remove(self, user_id: UserId):
-        if user_id in self:
+        self.spilled.discard(user_id)
+        self.wheel.cancel(user_id)
+        if super().__contains__(user_id):
             self.__delitem__(user_id)
             print(
-                f"DialogManager: Removed {user_id}. Currently expecting {len(self)} users: {list(self.keys())}"
+                f"DialogManager: Removed {user_id}. Currently expecting {len(self) + len(self.spilled)} users."
             )
 
     def cancel(self, user_id: UserId):
@@ -446,6 +537,107 @@ class DialogManager(OrderedDict):
                     "Cannot call 'cancel()' on a Reply; only Dialog supports it."
                 )
 
+    """ Persistence """
+
+    async def restore(self) -> int:
+        if self.store:
+            self.spilled = set(await self.store.keys())
+            # Idle time before the restart is not known here, each conversation gets a full timeout
+            for user_id in self.spilled:
+                self.touch(user_id)
+        return len(self.spilled)
+
+    @asynccontextmanager
+    async def lock(self, user_id: UserId) -> AsyncIterator[None]:
+        # Within this process first, idle expiry running outside of the updates' ordering, then across workers
+        lock = self.user_locks.setdefault(user_id, Lock())
+        self.lock_users[user_id] = self.lock_users.get(user_id, 0) + 1
+        try:
+            async with lock:
+                async with (
+                    self.locks(user_id) if self.shared and self.locks else nullcontext()
+                ):
+                    yield
+        finally:
+            self.lock_users[user_id] -= 1
+            if not self.lock_users[user_id]:
+                del self.lock_users[user_id], self.user_locks[user_id]
+
+    async def fetch(self, user_id: UserId) -> None | Interaction:
+        # Another worker may have moved the conversation forward since it was cached
+        if not self.shared and (interaction := self[user_id]):
+            self.move_to_end(user_id)
+            self.touch(user_id)
+            return interaction
+
+        if self.store and (doc := await self.store.load(user_id)):
+            interaction = load_interaction(doc)
+            self.spilled.discard(user_id)
+            self.__setitem__(user_id, interaction)
+            return interaction
+
+        if self.shared:
+            # Taken over and completed by another worker
+            self.remove(user_id)
+
+    async def save(self, user_id: UserId):
+        # Stamped for the other workers to tell whether the conversation is idle
+        if self.store and (interaction := self[user_id]):
+            await self.store.save(user_id, interaction.as_dict() | {"at": time()})
+
+    async def put(self, user_id: UserId, interaction: Interaction):
+        self.add(user_id, interaction)
+        await self.save(user_id)
+
+    async def drop(self, user_id: UserId):
+        self.remove(user_id)
+        if self.store:
+            await self.store.delete(user_id)
+
+    """ Idle timeouts """
+
+    def touch(self, user_id: UserId):
+        if self.idle_timeout:
+            self.wheel.schedule(user_id, self.idle_timeout)
+
+    async def expire(self, user_id: UserId) -> None | Interaction:
+        # Drops the conversation and returns it, unless it turns out not to be idle after all
+        if user_id in self.wheel:
+            return None
+        interaction = self[user_id]
+        if self.store and (doc := await self.store.load(user_id)):
+            idle = time() - doc.get("at", 0)
+            # Touched in the meantime, by this worker or by another one
+            if user_id in self.wheel:
+                return None
+            if self.shared and self.idle_timeout and idle < self.idle_timeout:
+                self.wheel.schedule(user_id, self.idle_timeout - idle)
+                return None
+            interaction = interaction or load_interaction(doc)
+        await self.drop(user_id)
+        return interaction
+
+    def start(self, on_idle: Callable[[list[UserId]], Awaitable[Any]]):
+        self.on_idle = on_idle
+        if self.idle_timeout and not self.task:
+            self.task = create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await sleep(self.wheel.tick)
+            if (expired := self.wheel.advance()) and self.on_idle:
+                try:
+                    await self.on_idle(expired)
+                except Exception as error:
+                    print(
+                        f"DialogManager: failed to expire idle conversations: {error}"
+                    )
+
 
 """ Views """
 
@@ -464,22 +656,15 @@ class Status(NamedTuple):
     work_summary: str
 
     def render(self) -> str:
-        _render = lambda nt: reduce(reducer, nt._asdict().items(), "")
-
-        def reducer(acc: str, keyval: Any) -> str:
-            k, v = keyval[0], keyval[1]
-
-            if not v:
-                return acc
-
-            elif isinstance(v, list):
-                match v[0]:
-                    case UserWithName():
-                        return acc + f"\n{k}: {', '.join([_render(x) for x in v])}\n"
-                    case _:
-                        return acc + ", ".join([str(x) for x in v])
-
-            else:
-                return acc + f"\n{k}: {str(v)}"
-
-        return _render(self)
+        # Pieces are joined once, so that rendering stays linear in the number of users
+        def render_user(user: UserWithName) -> str:
+            return "".join(f"\n{k}: {v}" for k, v in zip(user._fields, user) if v)
+
+        def render_field(k: str, v: Any) -> str:
+            if isinstance(v, list):
+                if isinstance(v[0], UserWithName):
+                    return f"\n{k}: {', '.join(map(render_user, v))}\n"
+                return ", ".join(map(str, v))
+            return f"\n{k}: {v}"
+
+        return "".join(render_field(k, v) for k, v in zip(self._fields, self) if v)
@@ -1,11 +1,13 @@
 from asyncio import as_completed
 from datetime import date, datetime, timedelta
 from functools import wraps
-from typing import Any, Callable, Coroutine, Generator, Iterable
+from typing import Any, Callable, Coroutine, Generator, Iterable, Iterator
 
-from telegram import ChatMember, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup
 
-from app.types import ChatId, UserId
+from app import admins_cache
+from app.callbacks import encode
+from app.types import ChatAdmins, ChatId, UserId
 
 
 def average_nb_secs(datetimes: list[datetime]) -> None | int:
@@ -42,31 +44,115 @@ def admins_ids_mkup(admins: Iterable[ChatMember]) -> str:
     )
 
 
+async def fetch_admins(bot: Bot, chat_id: ChatId) -> ChatAdmins:
+    if cached := admins_cache.fetch(chat_id):
+        return cached
+
+    admins = await bot.get_chat_administrators(chat_id)
+    chat_admins = ChatAdmins(
+        ids=frozenset(admin.user.id for admin in admins),
+        mkup=admins_ids_mkup(admins),
+    )
+    admins_cache.put(chat_id, chat_admins)
+    return chat_admins
+
+
 def agree_btn(
-    text: str, from_chat_id: ChatId, target_chat_id: ChatId, target_chat_url: str
+    text: str, from_chat_id: ChatId, target_chat_id: ChatId
 ) -> InlineKeyboardMarkup:
     button = InlineKeyboardButton(
         text=text,
-        callback_data=f"self-confirm§{from_chat_id}§{target_chat_id}§{target_chat_url}",
+        callback_data=encode("self-confirm", from_chat_id, target_chat_id),
     )
     return InlineKeyboardMarkup([[button]])
 
 
 def accept_or_reject_btns(
-    user_id: UserId, user_name: str, chat_id: ChatId, chat_url: str
+    user_id: UserId, user_name: str, chat_id: ChatId
 ) -> InlineKeyboardMarkup:
     accept = InlineKeyboardButton(
         text="Accept",
-        callback_data=f"accept§{chat_id}§{chat_url}§{user_id}§{user_name}",
+        callback_data=encode("accept", chat_id, user_id, text=user_name),
     )
     reject = InlineKeyboardButton(
         text="Reject",
-        callback_data=f"reject§{chat_id}§{chat_url}§{user_id}§{user_name}",
+        callback_data=encode("reject", chat_id, user_id, text=user_name),
     )
     keyboard = InlineKeyboardMarkup([[accept, reject]])
     return keyboard
 
 
+DIGEST_PAGE_SIZE = 8
+
+
+def digest_page(digest: dict) -> tuple[str, InlineKeyboardMarkup]:
+    # One page of a digest, with a button per user plus navigation and bulk verdicts
+    users, digest_id = digest["users"], str(digest["_id"])
+    pages = max(1, -(-len(users) // DIGEST_PAGE_SIZE))
+    page = min(digest.get("page", 0), pages - 1)
+    shown = users[page * DIGEST_PAGE_SIZE : (page + 1) * DIGEST_PAGE_SIZE]
+
+    text = (
+        f"{digest['alert']}\n{len(users)} users are waiting to join {mention_markdown(digest['chat_id'], digest['chat_name'])}, you might want to review them"
+        + (f" (page {page + 1}/{pages})" if pages > 1 else "")
+        + ":\n"
+        + "\n".join(
+            f"- {mention_markdown(u['user_id'], u['user_name'])}" for u in shown
+        )
+    )
+    rows = [
+        [
+            InlineKeyboardButton(
+                text=f"Accept {u['user_name']}",
+                callback_data=encode("digest-accept", digest_id, u["user_id"]),
+            ),
+            InlineKeyboardButton(
+                text=f"Reject {u['user_name']}",
+                callback_data=encode("digest-reject", digest_id, u["user_id"]),
+            ),
+        ]
+        for u in shown
+    ]
+    navigation = [
+        InlineKeyboardButton(
+            text=label, callback_data=encode("digest-page", digest_id, p)
+        )
+        for label, p in (("< Previous", page - 1), ("Next >", page + 1))
+        if 0 <= p < pages
+    ]
+    if navigation:
+        rows.append(navigation)
+    rows.append(
+        [
+            InlineKeyboardButton(
+                text=f"Accept all ({len(users)})",
+                callback_data=encode("digest-accept-all", digest_id),
+            ),
+            InlineKeyboardButton(
+                text=f"Reject all ({len(users)})",
+                callback_data=encode("digest-reject-all", digest_id),
+            ),
+        ]
+    )
+    return text, InlineKeyboardMarkup(rows)
+
+
+def status_btns(
+    chat_id: ChatId, page: int, has_next: bool
+) -> InlineKeyboardMarkup | None:
+    buttons = [
+        InlineKeyboardButton(
+            text=label, callback_data=encode("status-page", chat_id, p)
+        )
+        for label, p, shown in (
+            ("< Previous", page - 1, page > 0),
+            ("Next >", page + 1, has_next),
+        )
+        if shown
+    ]
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
 def withAuth(f: Callable):
     @wraps(f)
     async def inner(*args, **kwargs):
@@ -86,8 +172,8 @@ def withAuth(f: Callable):
             # Private message, which means the bot vouches for the user
             return await f(*args, **kwargs)
 
-        admins = await context.bot.get_chat_administrators(chat_id)
-        if user_id in [admin.user.id for admin in admins]:
+        admins = await fetch_admins(context.bot, chat_id)
+        if user_id in admins.ids:
             return await f(*args, **kwargs)
         else:
             await context.bot.send_message(
@@ -138,23 +224,40 @@ def into_pipeline(
             yield tmp
 
 
-def slice_on_n(s: str, n=4096, acc=None) -> list[str]:
-    if acc is None:
-        acc = []
+def utf16_len(s: str) -> int:
+    # Telegram counts message lengths in UTF-16 code units
+    return len(s.encode("utf-16-le")) // 2
 
-    if len(s) <= n:
-        acc.append(s)
-        return acc
 
-    sli = s[:n]
-    before_after = sli.rsplit("\n", 1)
-    acc.append(before_after[0])
+def iter_slices(s: str, n=4096) -> Iterator[str]:
+    # Cuts on the last line break of each window when there is one, dropping it
+    if not s:
+        yield s
+        return
 
-    return slice_on_n(
-        (before_after[1] + s[n:] if len(before_after) == 2 else s[n:]),
-        n,
-        acc,
-    )
+    start = 0
+    while start < len(s):
+        end = min(start + n, len(s))
+        # Characters outside of the BMP count twice: shrinking the window until it fits
+        while (excess := utf16_len(s[start:end]) - n) > 0:
+            end -= (excess + 1) // 2
+        # A window too small for the character at `start` still moves on, by that character
+        end = max(end, start + 1)
+
+        if end == len(s):
+            yield s[start:]
+            return
+
+        if (cut := s.rfind("\n", start, end)) > start:
+            yield s[start:cut]
+            start = cut + 1
+        else:
+            yield s[start:end]
+            start = end
+
+
+def slice_on_n(s: str, n=4096) -> list[str]:
+    return list(iter_slices(s, n))
 
 
 def appropriate_emoji() -> str:
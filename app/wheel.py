@@ -0,0 +1,62 @@
+from math import ceil
+from time import monotonic
+from typing import Hashable, Optional
+
+""" Idle timeouts, in a hashed timing wheel """
+
+
+class TimingWheel:
+    """
+    Timeouts filed into `slots` buckets of `tick` seconds each, by expiry: a timeout further away than a full turn
+    of the wheel waits for as many turns in its bucket. Scheduling, cancelling and rescheduling are O(1), and each
+    tick only visits its own bucket, so that expiring stays O(1) amortized however many timeouts are pending.
+    """
+
+    tick: float
+    # Per bucket, the turns each timeout has yet to wait
+    buckets: list[dict[Hashable, int]]
+    # Bucket of each timeout, to cancel it without looking for it
+    where: dict[Hashable, int]
+    origin: float
+    ticks: int
+
+    def __init__(self, tick: float = 60, slots: int = 512, now: Optional[float] = None):
+        self.tick = tick
+        self.buckets = [{} for _ in range(slots)]
+        self.where = {}
+        self.origin = monotonic() if now is None else now
+        self.ticks = 0
+
+    def __len__(self) -> int:
+        return len(self.where)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.where
+
+    def schedule(self, key: Hashable, delay: float):
+        # Scheduling again replaces the previous timeout
+        self.cancel(key)
+        ahead = max(ceil(delay / self.tick), 1)
+        slot = (self.ticks + ahead) % len(self.buckets)
+        self.buckets[slot][key] = (ahead - 1) // len(self.buckets)
+        self.where[key] = slot
+
+    def cancel(self, key: Hashable):
+        if (slot := self.where.pop(key, None)) is not None:
+            del self.buckets[slot][key]
+
+    def advance(self, now: Optional[float] = None) -> list[Hashable]:
+        # Every tick elapsed since the last call is caught up with, returns the keys that timed out
+        now = monotonic() if now is None else now
+        expired: list[Hashable] = []
+        while self.ticks < (now - self.origin) // self.tick:
+            self.ticks += 1
+            bucket = self.buckets[self.ticks % len(self.buckets)]
+            for key, turns in list(bucket.items()):
+                if turns:
+                    bucket[key] = turns - 1
+                else:
+                    del bucket[key]
+                    del self.where[key]
+                    expired.append(key)
+        return expired
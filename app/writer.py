@@ -0,0 +1,108 @@
+from asyncio import Event, Lock, Task, TimeoutError, create_task, wait_for
+from time import monotonic
+from typing import Optional, TypeAlias
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+WriteOp: TypeAlias = InsertOne | UpdateOne
+
+
+class LogWriter:
+    """
+    Write-behind buffer in front of a collection. Operations are flushed as ordered bulk writes
+    once `max_batch` of them are queued, every `interval` seconds, or on shutdown.
+    """
+
+    collection: AsyncIOMotorCollection
+    max_batch: int
+    interval: float
+    queue: list[WriteOp]
+    flushed: int
+    last_flush_latency: float
+    task: Optional[Task]
+
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        max_batch: int = 500,
+        interval: float = 1.0,
+    ):
+        self.collection = collection
+        self.max_batch = max_batch
+        self.interval = interval
+        self.queue = []
+        self.flushed = 0
+        self.last_flush_latency = 0
+        self.task = None
+        self._lock = Lock()
+        self._wakeup = Event()
+
+    @property
+    def depth(self) -> int:
+        return len(self.queue)
+
+    @property
+    def stats(self) -> str:
+        return f"{self.depth} queued, {self.flushed} flushed, last flush took {self.last_flush_latency:.3f}s"
+
+    async def write(self, op: WriteOp):
+        self.queue.append(op)
+
+        # Without a running flusher (tests, one-off scripts) writes go through right away
+        if not self.task:
+            await self.flush()
+        elif len(self.queue) >= self.max_batch:
+            self._wakeup.set()
+
+    async def flush(self) -> int:
+        async with self._lock:
+            batch, self.queue = self.queue, []
+            if not batch:
+                return 0
+
+            started = monotonic()
+            try:
+                await self.collection.bulk_write(batch, ordered=True)
+            except BulkWriteError as error:
+                if not (write_errors := error.details.get("writeErrors")):
+                    # Only the write concern failed: keeping the whole batch for the next attempt
+                    self.queue = batch + self.queue
+                    raise
+                # An ordered bulk write stops at the first error: skipping the culprit, retrying the rest later
+                failed_at = write_errors[0]["index"]
+                print(f"LogWriter: dropped {batch[failed_at]}: {error}")
+                self.queue = batch[failed_at + 1 :] + self.queue
+                batch = batch[:failed_at]
+            except Exception:
+                # Keeping the whole batch for the next attempt
+                self.queue = batch + self.queue
+                raise
+
+            self.last_flush_latency = monotonic() - started
+            self.flushed += len(batch)
+            return len(batch)
+
+    def start(self):
+        if not self.task:
+            self.task = create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await wait_for(self._wakeup.wait(), self.interval)
+            except TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+            except Exception as error:
+                print(f"LogWriter: failed to flush {self.depth} operations: {error}")
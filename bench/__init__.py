@@ -0,0 +1,12 @@
+"""
+Benchmarks and load tools. They run against a fake Bot API and, in-process, an in-memory MongoDB stand-in.
+"""
+from os import environ
+
+from mongomock_motor import AsyncMongoMockClient
+from motor import motor_asyncio
+
+# The app connects to MongoDB on first use: the stand-in has to be in place before
+motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+environ.setdefault("MONGO_CONN_STRING", "mongodb://localhost")
+environ.setdefault("ADMIN", "1")
@@ -0,0 +1,320 @@
+"""
+Drives synthetic traffic through the real handlers and reports throughput and latency per scenario.
+
+    python -m bench                     # every scenario, compared with bench/baseline.json
+    python -m bench --save              # same, then stores the results as the new baseline
+    python -m bench join_storm --size 5000 --concurrency 8 --bot-latency 50
+"""
+import json
+import logging
+from argparse import ArgumentParser
+from asyncio import gather, run
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from io import StringIO
+from pathlib import Path
+from sys import stderr
+from time import perf_counter
+from typing import Awaitable, Callable, NamedTuple
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes
+
+from app import admins_cache, ctx, notifications, recent_updates, settings_cache
+from app.__main__ import registerHandlers
+from app.callbacks import encode
+from app.db import background_task, upsert_questionnaire, upsert_settings
+from app.processor import OrderedProcessor
+from app.types import Questionnaire, Settings
+from bench.fakes import (
+    CHATS,
+    FakeBot,
+    callback_query,
+    join_request,
+    new_chat_members,
+    private_message,
+)
+
+BASELINE = Path(__file__).parent / "baseline.json"
+
+""" Results """
+
+
+class Result(NamedTuple):
+    ops: int
+    elapsed: float
+    latencies: list[float]
+    errors: int
+
+    def percentile(self, q: float) -> float:
+        ordered = sorted(self.latencies)
+        return ordered[int(q * (len(ordered) - 1))] if ordered else 0
+
+    def as_dict(self) -> dict:
+        return {
+            "throughput": round(self.ops / self.elapsed, 1),
+            "p50_ms": round(self.percentile(0.5) * 1000, 3),
+            "p99_ms": round(self.percentile(0.99) * 1000, 3),
+        }
+
+
+def compare(name: str, result: dict, baseline: dict) -> str:
+    if name not in baseline:
+        return "no baseline"
+    deltas = []
+    for key, value in result.items():
+        if before := baseline[name].get(key):
+            deltas.append(f"{key} {(value - before) / before:+.0%}")
+    return ", ".join(deltas)
+
+
+""" Driving updates through the application """
+
+
+class Bench:
+    app: Application
+    bot: FakeBot
+    concurrency: int
+    errors: int
+
+    def __init__(self, app: Application, bot: FakeBot, concurrency: int):
+        self.app = app
+        self.bot = bot
+        self.concurrency = concurrency
+        self.errors = 0
+        app.add_error_handler(self.on_error)
+
+    async def on_error(self, _: object, context: ContextTypes.DEFAULT_TYPE):
+        self.errors += 1
+        if self.errors == 1:
+            print(f"First error: {context.error!r}", file=stderr)
+
+    async def process(self, waves: list[list[dict]]) -> Result:
+        # Waves are processed one after the other, updates within a wave as the bot would:
+        # concurrently, in order per chat and per user
+        processor = OrderedProcessor(self.concurrency)
+        latencies: list[float] = []
+
+        async def one(update: Update):
+            started = perf_counter()
+            await self.app.process_update(update)
+            latencies.append(perf_counter() - started)
+
+        errors, started = self.errors, perf_counter()
+        for wave in waves:
+            await gather(
+                *(
+                    processor.submit(Update.de_json(data, self.bot), one)
+                    for data in wave
+                )
+            )
+        await ctx.log_writer.flush()
+        return Result(
+            len(latencies), perf_counter() - started, latencies, self.errors - errors
+        )
+
+
+async def configure(mode: str, **extra):
+    for chat_id in CHATS:
+        settings = {"mode": mode, "chat_url": "https://t.me/bench"} | extra
+        await upsert_settings(Settings(settings, chat_id))
+
+
+async def seed_join_requests(size: int, at: Callable[[int], datetime]):
+    await ctx.logs.insert_many(
+        [
+            {
+                "operation": "wants_to_join",
+                "chat_id": CHATS[i % len(CHATS)],
+                "user_id": 10_000 + i,
+                "username": f"user{10_000 + i}",
+                "at": at(i),
+            }
+            for i in range(size)
+        ]
+    )
+
+
+async def reset_state():
+    await ctx.client.drop_database("alert-me")
+    for cache in (settings_cache, admins_cache, recent_updates, ctx.dialog_manager):
+        cache.clear()
+    ctx.dialog_manager.spilled.clear()
+
+
+""" Scenarios """
+
+
+async def join_storm(bench: Bench, size: int) -> Result:
+    await configure("auto")
+    return await bench.process(
+        [[join_request(i, CHATS[i % len(CHATS)], 10_000 + i) for i in range(size)]]
+    )
+
+
+async def redelivery(bench: Bench, size: int) -> Result:
+    # Every join request delivered twice, as Telegram does when the webhook is slow: the copies are dropped
+    await configure("auto")
+    joins = [
+        join_request(i, CHATS[i % len(CHATS)], 10_000 + i) for i in range(size // 2)
+    ]
+    before = bench.bot.calls["sendMessage"]
+    result = await bench.process([joins, joins])
+    assert bench.bot.calls["sendMessage"] - before == len(joins)
+    return result
+
+
+async def manual_burst(bench: Bench, size: int) -> Result:
+    # Admins get digests rather than a message per request
+    await configure("manual", helper_chat_id=-1002000000000)
+    result = await bench.process(
+        [[join_request(i, CHATS[i % len(CHATS)], 10_000 + i) for i in range(size)]]
+    )
+    await notifications.drain()
+    return result
+
+
+async def questionnaire(bench: Bench, size: int) -> Result:
+    q = Questionnaire("Welcome!", ["Who are you?", "Why?", "Rules read?"], "Thanks")
+    await configure("questionnaire")
+    for chat_id in CHATS:
+        await upsert_questionnaire(chat_id, q)
+
+    users = [10_000 + i for i in range(size // (len(q.questions) + 1))]
+    joins = [join_request(i, CHATS[i % len(CHATS)], u) for i, u in enumerate(users)]
+    answers = [
+        [private_message(n * size + i, u, f"Answer {n}") for i, u in enumerate(users)]
+        for n in range(1, len(q.questions) + 1)
+    ]
+    return await bench.process([joins, *answers])
+
+
+async def callback_flood(bench: Bench, size: int) -> Result:
+    return await bench.process(
+        [
+            [
+                callback_query(
+                    i,
+                    10_000 + i,
+                    encode("self-confirm", 10_000 + i, CHATS[i % len(CHATS)]),
+                )
+                for i in range(size)
+            ]
+        ]
+    )
+
+
+async def new_members(bench: Bench, size: int) -> Result:
+    await configure("auto", show_join_time=True)
+    now = datetime.now()
+    await seed_join_requests(size, lambda _: now - timedelta(minutes=5))
+    return await bench.process(
+        [
+            [
+                new_chat_members(i, CHATS[i % len(CHATS)], [10_000 + i])
+                for i in range(size)
+            ]
+        ]
+    )
+
+
+async def mixed(bench: Bench, size: int) -> Result:
+    # Join requests, button presses and new members interleaved, as they come in production
+    await configure("auto", show_join_time=True)
+    kinds = [
+        lambda i: join_request(i, CHATS[i % len(CHATS)], 10_000 + i),
+        lambda i: callback_query(
+            i, 10_000 + i, encode("self-confirm", 10_000 + i, CHATS[i % len(CHATS)])
+        ),
+        lambda i: new_chat_members(i, CHATS[i % len(CHATS)], [10_000 + i]),
+    ]
+    return await bench.process([[kinds[i % len(kinds)](i) for i in range(size)]])
+
+
+async def sweep(bench: Bench, size: int) -> Result:
+    # One run over `size` join requests, half of them to be reminded, half to be expired
+    await configure("auto", ban_not_joining=True)
+    now = datetime.now()
+    await seed_join_requests(
+        size, lambda i: now - (timedelta(minutes=30) if i % 2 else timedelta(hours=7))
+    )
+    await ctx.logs.update_many(
+        {"at": {"$lt": now - timedelta(hours=1)}}, {"$set": {"notified": True}}
+    )
+
+    started = perf_counter()
+    await background_task(bench.bot)
+    elapsed = perf_counter() - started
+    return Result(size, elapsed, [elapsed], 0)
+
+
+SCENARIOS: dict[str, Callable[[Bench, int], Awaitable[Result]]] = {
+    "join_storm": join_storm,
+    "redelivery": redelivery,
+    "manual_burst": manual_burst,
+    "questionnaire": questionnaire,
+    "callback_flood": callback_flood,
+    "new_members": new_members,
+    "mixed": mixed,
+    "sweep": sweep,
+}
+
+
+async def main(
+    names: list[str], size: int, concurrency: int, bot_latency: float, save: bool
+):
+    bot = FakeBot(latency=bot_latency)
+    app = Application.builder().bot(bot).updater(None).build()
+    registerHandlers(app)
+    bench = Bench(app, bot, concurrency)
+    baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+    results = {}
+
+    # The app's own output would drown the results
+    logging.getLogger().setLevel(logging.WARNING)
+    await app.initialize()
+    ctx.log_writer.start()
+    print(
+        f"{'scenario':<16}{'ops':>8}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}"
+    )
+    for name in names:
+        await reset_state()
+        with redirect_stdout(StringIO()):
+            result = await SCENARIOS[name](bench, size)
+        results[name] = result.as_dict()
+        r = results[name]
+        print(
+            f"{name:<16}{result.ops:>8}{r['throughput']:>10}{r['p50_ms']:>10}{r['p99_ms']:>10}{result.errors:>8}"
+            + f"   {compare(name, r, baseline)}"
+        )
+    await ctx.log_writer.stop()
+    await app.shutdown()
+    print(f"Bot API calls: {dict(bot.calls)}")
+
+    if save:
+        BASELINE.write_text(json.dumps(baseline | results, indent=2) + "\n")
+        print(f"Baseline saved to {BASELINE}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="python -m bench")
+    parser.add_argument("scenarios", nargs="*", help=", ".join(SCENARIOS))
+    parser.add_argument("--size", type=int, default=1000, help="updates per scenario")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument(
+        "--bot-latency", type=float, default=0, help="Bot API latency, in ms"
+    )
+    parser.add_argument("--save", action="store_true", help="store as baseline")
+    args = parser.parse_args()
+    if unknown := set(args.scenarios) - set(SCENARIOS):
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    run(
+        main(
+            args.scenarios or list(SCENARIOS),
+            args.size,
+            args.concurrency,
+            args.bot_latency / 1000,
+            args.save,
+        )
+    )
@@ -0,0 +1,156 @@
+from asyncio import sleep
+from collections import Counter
+from itertools import count
+from time import time
+from typing import Any
+
+from telegram.ext import ExtBot
+
+""" Fake Bot API """
+
+BOT_ID = 1000
+ADMIN_ID = 1
+CHATS = [-1001000000000 - i for i in range(10)]
+BOT_USER = {
+    "id": BOT_ID,
+    "is_bot": True,
+    "first_name": "Ringo",
+    "username": "ringo_bot",
+}
+
+
+def fake_response(endpoint: str, data: dict[str, Any], message_id: int) -> Any:
+    # Minimal results the handlers make use of, anything else succeeds with `True`
+    match endpoint:
+        case "getMe":
+            return BOT_USER
+        case "getChatAdministrators":
+            return [
+                {
+                    "status": "creator",
+                    "user": user(ADMIN_ID),
+                    "is_anonymous": False,
+                }
+            ]
+        case endpoint if endpoint.startswith("send"):
+            return {
+                "message_id": message_id,
+                "date": int(time()),
+                "chat": chat(int(data["chat_id"])),
+                "from": BOT_USER,
+                "text": data.get("text", ""),
+            }
+        case _:
+            return True
+
+
+class FakeBot(ExtBot):
+    """
+    Bot answering every call locally after `latency` seconds, and counting calls per endpoint
+    """
+
+    latency: float
+    calls: Counter
+
+    def __init__(self, latency: float = 0):
+        super().__init__(f"{BOT_ID}:fake")
+        # Bots are frozen once initialised
+        with self._unfrozen():
+            self.latency = latency
+            self.calls = Counter()
+            self._message_ids = count(1)
+
+    async def _do_post(self, endpoint: str, data: dict, **kwargs) -> Any:
+        if self.latency:
+            await sleep(self.latency)
+        self.calls[endpoint] += 1
+        return fake_response(endpoint, data, next(self._message_ids))
+
+
+""" Synthetic updates, as sent by Telegram """
+
+
+def user(user_id: int) -> dict:
+    return {
+        "id": user_id,
+        "is_bot": False,
+        "first_name": f"User {user_id}",
+        "username": f"user{user_id}",
+        "language_code": "en",
+    }
+
+
+def chat(chat_id: int) -> dict:
+    if chat_id > 0:
+        return {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+    return {
+        "id": chat_id,
+        "type": "supergroup",
+        "title": f"Chat {chat_id}",
+        "username": f"chat{-chat_id}",
+    }
+
+
+def join_request(update_id: int, chat_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "chat_join_request": {
+            "chat": chat(chat_id),
+            "from": user(user_id),
+            "user_chat_id": user_id,
+            "date": int(time()),
+        },
+    }
+
+
+def callback_query(update_id: int, user_id: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time()),
+                "chat": chat(user_id),
+                "from": BOT_USER,
+                "text": "Please confirm",
+            },
+        },
+    }
+
+
+def new_chat_members(update_id: int, chat_id: int, user_ids: list[int]) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time()),
+            "chat": chat(chat_id),
+            "from": user(user_ids[0]),
+            "new_chat_members": [user(user_id) for user_id in user_ids],
+        },
+    }
+
+
+def private_message(
+    update_id: int, user_id: int, text: str, reply_to_bot: bool = False
+) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time()),
+        "chat": chat(user_id),
+        "from": user(user_id),
+        "text": text,
+    }
+    if reply_to_bot:
+        message["reply_to_message"] = {
+            "message_id": update_id - 1,
+            "date": int(time()),
+            "chat": chat(user_id),
+            "from": BOT_USER,
+            "text": "Hello",
+        }
+    return {"update_id": update_id, "message": message}
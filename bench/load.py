@@ -0,0 +1,297 @@
+"""
+Load generator for a running webhook. Synthetic updates are POSTed at increasing rates, and the bot
+is expected to talk to the fake Bot API served here, which records when each update got its answer.
+
+    # The load generator first, it serves the fake Bot API then waits for the webhook to be up
+    python -m bench.load --url http://localhost:8443/hook/bot1000:fake --rates 50,100,200,400
+    # The bot, in webhook mode, against the fake Bot API
+    BOT_API_URL=http://localhost:8081 HOST=http://localhost:8443/ ENDPOINT=hook TOKEN=1000:fake python -m app
+"""
+import json
+from argparse import ArgumentParser
+from asyncio import create_task, gather, open_connection, run, sleep
+from itertools import count, cycle
+from time import perf_counter, time
+from typing import Callable, Hashable, NamedTuple
+
+import httpx
+from tornado.web import Application, RequestHandler
+
+from app.callbacks import encode
+from bench.fakes import (
+    ADMIN_ID,
+    CHATS,
+    callback_query,
+    fake_response,
+    join_request,
+    new_chat_members,
+    private_message,
+)
+
+""" Fake Bot API, matching the bot's answers with the updates that caused them """
+
+# What the bot is expected to do, by update: first answer to a key, sent at a given time
+pending: dict[Hashable, float] = {}
+answered: list[float] = []
+message_ids = count(1)
+
+
+class BotApiHandler(RequestHandler):
+    # Seconds the fake Bot API takes to answer, making the handlers that slow
+    latency: float = 0
+
+    async def post(self, method: str):
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            data = json.loads(self.request.body or "{}")
+        else:
+            data = {k: v[0].decode() for k, v in self.request.body_arguments.items()}
+
+        match method:
+            case "answerCallbackQuery":
+                key = ("callback", str(data.get("callback_query_id")))
+            case _:
+                key = ("chat", int(data.get("chat_id", 0)))
+        if (sent_at := pending.pop(key, None)) is not None:
+            answered.append(perf_counter() - sent_at)
+
+        if self.latency:
+            await sleep(self.latency)
+        result = fake_response(method, data, next(message_ids))
+        self.write({"ok": True, "result": result})
+
+    def log_exception(self, *args):
+        pass
+
+
+def serve_bot_api(port: int, latency: float = 0):
+    BotApiHandler.latency = latency
+    Application([(r"/bot[^/]+/(\w+)", BotApiHandler)]).listen(port)
+
+
+""" Synthetic traffic """
+
+
+class Load(NamedTuple):
+    update: dict
+    # Expected answer
+    key: Hashable
+
+
+def join(update_id: int, user_id: int) -> Load:
+    chat_id = CHATS[update_id % len(CHATS)]
+    return Load(join_request(update_id, chat_id, user_id), ("chat", user_id))
+
+
+def callback(update_id: int, user_id: int) -> Load:
+    chat_id = CHATS[update_id % len(CHATS)]
+    data = encode("self-confirm", user_id, chat_id)
+    return Load(callback_query(update_id, user_id, data), ("callback", str(update_id)))
+
+
+def reply(update_id: int, user_id: int) -> Load:
+    return Load(
+        private_message(update_id, user_id, "Thanks", reply_to_bot=True),
+        ("chat", user_id),
+    )
+
+
+def members(update_id: int, user_id: int) -> Load:
+    # A chat of its own, so that the greeting can be told apart
+    chat_id = -2000000000000 - update_id
+    return Load(new_chat_members(update_id, chat_id, [user_id]), ("chat", chat_id))
+
+
+KINDS: dict[str, Callable[[int, int], Load]] = {
+    "join": join,
+    "callback": callback,
+    "reply": reply,
+    "members": members,
+}
+
+
+def parse_mix(spec: str) -> list[Callable[[int, int], Load]]:
+    # "join=6,callback=2" -> weighted round robin over the kinds
+    mix = []
+    for part in spec.split(","):
+        name, _, weight = part.strip().partition("=")
+        mix += [KINDS[name]] * int(weight or 1)
+    return mix
+
+
+""" Steps """
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))] if ordered else 0
+
+
+class Step(NamedTuple):
+    rate: float
+    sent: int
+    elapsed: float
+    errors: int
+    posted: list[float]
+    answered: list[float]
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.sent if self.sent else 0
+
+    @property
+    def answer_rate(self) -> float:
+        return len(self.answered) / self.sent if self.sent else 0
+
+    def healthy(self, slo: float) -> bool:
+        return (
+            self.error_rate <= 0.01
+            and self.answer_rate >= 0.99
+            and percentile(self.answered, 0.99) <= slo
+        )
+
+    def render(self) -> str:
+        ms = lambda values, q: f"{percentile(values, q) * 1000:.0f}"
+        return (
+            f"{self.rate:>8.0f}{self.sent / self.elapsed:>10.1f}{self.error_rate:>9.1%}"
+            + f"{ms(self.posted, 0.5):>9}{ms(self.posted, 0.99):>9}"
+            + f"{self.answer_rate:>10.1%}{ms(self.answered, 0.5):>9}{ms(self.answered, 0.99):>9}"
+        )
+
+
+class Generator:
+    url: str
+    mix: cycle
+    client: httpx.AsyncClient
+
+    def __init__(self, url: str, mix: list[Callable[[int, int], Load]]):
+        self.url = url
+        self.mix = cycle(mix)
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=1000), timeout=30
+        )
+        # Fresh ids on every run, users included, so that nothing looks like a replay
+        self.ids = count(int(time() * 1000))
+
+    async def post(self, update: dict) -> bool:
+        try:
+            response = await self.client.post(self.url, json=update)
+            return response.status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    async def wait_for_webhook(self, timeout: float = 60):
+        url = httpx.URL(self.url)
+        waited = 0.0
+        while waited < timeout:
+            try:
+                _, writer = await open_connection(url.host, url.port or 80)
+                writer.close()
+                return
+            except OSError:
+                await sleep(0.5)
+                waited += 0.5
+        raise SystemExit(f"The webhook was not up within {timeout}s")
+
+    async def setup(self, timeout: float = 10):
+        # Chats are configured through the bot itself, the fake Bot API reporting the sender as an admin
+        for chat_id in CHATS:
+            update_id = next(self.ids)
+            message = private_message(update_id, ADMIN_ID, "")["message"]
+            message["chat"] = {"id": chat_id, "type": "supergroup", "title": "Load"}
+            message["text"] = "/set mode auto chat_url https://t.me/load"
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": 4}]
+            pending[("chat", chat_id)] = perf_counter()
+            await self.post({"update_id": update_id, "message": message})
+
+        waited = 0.0
+        while pending and waited < timeout:
+            await sleep(0.1)
+            waited += 0.1
+        if pending:
+            raise SystemExit(f"The bot did not answer /set within {timeout}s")
+        answered.clear()
+
+    async def step(self, rate: float, duration: float, grace: float) -> Step:
+        pending.clear()
+        answered.clear()
+        posted: list[float] = []
+        errors = 0
+
+        async def one(load: Load):
+            nonlocal errors
+            started = perf_counter()
+            pending[load.key] = started
+            if not await self.post(load.update):
+                errors += 1
+                pending.pop(load.key, None)
+            posted.append(perf_counter() - started)
+
+        # Open loop: updates keep coming at the given rate whatever the bot's response time
+        tasks = []
+        started = perf_counter()
+        for i in range(int(rate * duration)):
+            if (delay := started + i / rate - perf_counter()) > 0:
+                await sleep(delay)
+            update_id = next(self.ids)
+            tasks.append(create_task(one(next(self.mix)(update_id, update_id))))
+        await gather(*tasks)
+        elapsed = perf_counter() - started
+
+        waited = 0.0
+        while pending and waited < grace:
+            await sleep(0.1)
+            waited += 0.1
+        return Step(rate, len(tasks), elapsed, errors, posted, list(answered))
+
+
+async def main(args):
+    serve_bot_api(args.bot_api_port, args.bot_api_latency / 1000)
+    print(f"Fake Bot API listening on port {args.bot_api_port}")
+    generator = Generator(args.url, parse_mix(args.mix))
+    await generator.wait_for_webhook()
+    await generator.setup()
+
+    print(
+        f"{'rate/s':>8}{'sent/s':>10}{'errors':>9}{'post p50':>9}{'p99':>9}"
+        + f"{'answered':>10}{'e2e p50':>9}{'p99':>9}   (ms)"
+    )
+    healthy_up_to = None
+    for rate in args.rates:
+        step = await generator.step(rate, args.duration, args.grace)
+        print(step.render())
+        if not step.healthy(args.slo / 1000):
+            print(
+                f"Saturated at {rate:.0f} updates/s"
+                + (f", healthy up to {healthy_up_to:.0f}/s" if healthy_up_to else "")
+            )
+            break
+        healthy_up_to = rate
+    else:
+        print(f"Healthy up to {healthy_up_to:.0f} updates/s, try higher rates")
+    await generator.client.aclose()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="python -m bench.load")
+    parser.add_argument("--url", required=True, help="webhook URL, with its url_path")
+    parser.add_argument(
+        "--rates",
+        type=lambda s: [float(r) for r in s.split(",")],
+        default=[25, 50, 100, 200, 400, 800],
+        help="updates per second, one step each",
+    )
+    parser.add_argument("--duration", type=float, default=10, help="seconds per step")
+    parser.add_argument(
+        "--grace", type=float, default=5, help="seconds to wait for late answers"
+    )
+    parser.add_argument(
+        "--mix", default="join=6,callback=2,reply=1,members=1", help="kinds of updates"
+    )
+    parser.add_argument(
+        "--slo", type=float, default=1000, help="end-to-end p99 deemed healthy, in ms"
+    )
+    parser.add_argument("--bot-api-port", type=int, default=8081)
+    parser.add_argument(
+        "--bot-api-latency", type=float, default=0, help="fake Bot API latency, in ms"
+    )
+    run(main(parser.parse_args()))
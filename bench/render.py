@@ -0,0 +1,75 @@
+"""
+Times the /status and /settings renderers against the number of users listed, to check that it grows linearly.
+
+    python -m bench.render
+    python -m bench.render --sizes 1000,10000,100000 --repeat 5
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+from time import perf_counter
+from typing import Callable
+
+from app.types import Questionnaire, Settings, Status, UserWithName
+
+
+def status(size: int) -> Status:
+    at = datetime(2023, 5, 1, 12, 0)
+    users = [UserWithName(i, f"user_{i}", at) for i in range(size)]
+    third = size // 3
+    return Status(
+        -1001000000000, users[:third], users[third : 2 * third], users[2 * third :], ""
+    )
+
+
+def settings(size: int) -> Settings:
+    # Questions stand for users here, what grows being the rendered questionnaire
+    questions = [f"Question_{i}?" for i in range(size)]
+    return Settings(
+        {
+            "mode": "questionnaire",
+            "chat_url": "https://t.me/bench",
+            "questionnaire": Questionnaire("Welcome!", questions, "Thanks")._asdict(),
+        },
+        -1001000000000,
+    )
+
+
+def best_of(render: Callable[[], str], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = perf_counter()
+        render()
+        timings.append(perf_counter() - started)
+    return min(timings)
+
+
+def main(sizes: list[int], repeat: int):
+    print(f"{'size':>8}{'status ms':>12}{'growth':>8}{'settings ms':>14}{'growth':>8}")
+    previous: tuple[int, float, float] | None = None
+    for size in sizes:
+        s, t = status(size), settings(size)
+        status_time = best_of(s.render, repeat)
+        settings_time = best_of(t.render, repeat)
+
+        # Linear rendering grows like the size, quadratic rendering like its square
+        growth = lambda now, before: (
+            f"{now / before:.1f}x" if previous and before else "-"
+        )
+        print(
+            f"{size:>8}{status_time * 1000:>12.2f}{growth(status_time, previous and previous[1]):>8}"
+            + f"{settings_time * 1000:>14.2f}{growth(settings_time, previous and previous[2]):>8}"
+        )
+        previous = (size, status_time, settings_time)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="python -m bench.render")
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(n) for n in s.split(",")],
+        default=[100, 1000, 10_000, 100_000],
+        help="users per rendered view",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="best of that many runs")
+    args = parser.parse_args()
+    main(args.sizes, args.repeat)
@@ -0,0 +1,71 @@
+"""
+Measures how long `python -m app` takes to import, in fresh interpreters, and fails past a budget.
+Nothing is connected nor read on import: the database, strings and conversations are set up on first use.
+
+    python -m bench.startup                 # best of 5, against the default budget
+    python -m bench.startup --budget 400 --top 15
+"""
+import re
+from argparse import ArgumentParser
+from os import environ
+from subprocess import run
+from sys import executable
+
+# Cumulative import time, in ms, of `app.__main__` and everything it pulls in
+BUDGET = 600
+
+IMPORTTIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def measure(module: str) -> dict[str, int]:
+    # Cumulative time, in µs, of the module itself and of each package imported by the app's own modules
+    env = {k: v for k, v in environ.items() if k != "MONGO_CONN_STRING"}
+    stderr = run(
+        [executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    packages: dict[str, int] = {}
+    # Modules are reported after their own imports: read backwards, parents come first
+    parents: list[str] = []
+    for line in reversed(stderr.splitlines()):
+        if not (match := IMPORTTIME.match(line)):
+            continue
+        _, cumulative, indent, name = match.groups()
+        depth = len(indent) // 2
+        del parents[depth:]
+        top = name.split(".")[0]
+        if name == module:
+            packages[module] = int(cumulative)
+        elif parents and parents[-1].split(".")[0] == "app" and top != "app":
+            packages[top] = packages.get(top, 0) + int(cumulative)
+        parents.append(name)
+    return packages
+
+
+def main(module: str, budget: float, repeat: int, top: int):
+    runs = [measure(module) for _ in range(repeat)]
+    best = min(runs, key=lambda packages: packages[module])
+    total = best[module] / 1000
+
+    print(f"{module}: {total:.0f} ms (best of {repeat}), budget {budget:.0f} ms")
+    heaviest = sorted(
+        ((ms, name) for name, ms in best.items() if name != module), reverse=True
+    )
+    for us, name in heaviest[:top]:
+        print(f"{us / 1000:>10.1f} ms  {name}")
+
+    if total > budget:
+        raise SystemExit(f"Over budget by {total - budget:.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="python -m bench.startup")
+    parser.add_argument("--module", default="app.__main__")
+    parser.add_argument("--budget", type=float, default=BUDGET, help="in ms")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="heaviest imports shown")
+    args = parser.parse_args()
+    main(args.module, args.budget, args.repeat, args.top)
@@ -1,9 +1,27 @@
-from asyncio import as_completed, gather, get_event_loop_policy
+from asyncio import as_completed, gather, get_event_loop_policy, get_running_loop, sleep
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
 from typing import Any, Coroutine
 
+import httpx
 import pytest
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError
+from telegram.ext import ApplicationHandlerStop
 
+from app import ctx, db, notifications, scheduler
+from app.__main__ import build_app, on_shutdown, on_stop
+from app.coalescer import Coalescer
 from app.db import background_task, fetch_chat_ids, fetch_settings, get_status
+from app.handlers import dropping_duplicates
+from app.ingress import Ingress
+from app.lease import Lease
+from app.processor import OrderedProcessor
+from app.ratelimiter import TokenBucket
+from app.store import SQLiteDialogStore
+from app.types import Dialog, DialogManager, Questionnaire, User
+from app.wheel import TimingWheel
+from app.writer import LogWriter
 
 
 @pytest.fixture(scope="session")
@@ -37,6 +55,328 @@ async def test_collect_failed():
     assert len(failed) == 2
 
 
+@pytest.mark.asyncio
+async def test_token_bucket_priorities():
+    bucket = TokenBucket(rate=100, capacity=1)
+    served = []
+
+    async def acquire(tag: str, priority: int):
+        await bucket.acquire(priority)
+        served.append(tag)
+
+    await gather(
+        acquire("first", 10),
+        acquire("bulk", 10),
+        acquire("other bulk", 10),
+        acquire("interactive", 0),
+    )
+    assert served == ["first", "interactive", "bulk", "other bulk"]
+
+
+@pytest.mark.asyncio
+async def test_dialog_manager_spills_to_store(tmp_path):
+    store = SQLiteDialogStore(str(tmp_path / "dialogs.sqlite"))
+    manager = DialogManager(max_size=1, store=store)
+    q = Questionnaire("intro", ["q1"], "outro")
+
+    await manager.put(1, Dialog(1, 1, q, None))
+    await manager.put(2, Dialog(2, 1, q, None))
+    assert len(manager) == 1 and 1 in manager
+
+    # Evicted from memory, reloaded from the store, then surviving a restart
+    assert isinstance(await manager.fetch(1), Dialog)
+    restarted = DialogManager(max_size=1, store=store)
+    assert await restarted.restore() == 2
+
+    await restarted.drop(2)
+    assert 2 not in restarted and await store.load(2) is None
+
+
+@pytest.mark.asyncio
+async def test_dialog_manager_expires_idle(tmp_path):
+    store = SQLiteDialogStore(str(tmp_path / "dialogs.sqlite"))
+    manager = DialogManager(
+        store=store, idle_timeout=0.2, wheel=TimingWheel(tick=0.05, slots=8)
+    )
+    q = Questionnaire("intro", ["q1"], "outro")
+    expired = []
+
+    async def on_idle(user_ids):
+        for user_id in user_ids:
+            expired.append(await manager.expire(user_id))
+
+    manager.start(on_idle)
+    await manager.put(1, Dialog(1, 1, q, None))
+    await manager.put(2, Dialog(2, 1, q, None))
+    for _ in range(5):
+        await sleep(0.1)
+        await manager.fetch(2)
+    await manager.stop()
+
+    # Only the conversation left unanswered is dropped, from memory and from the store
+    assert [dialog.user_id for dialog in expired] == [1]
+    assert 1 not in manager and await store.load(1) is None
+    assert 2 in manager
+
+    # Another worker saved the conversation lately: it is not idle after all
+    shared = DialogManager(store=store, shared=True, idle_timeout=60)
+    assert await shared.expire(2) is None and 2 in shared.wheel
+
+
+@pytest.mark.asyncio
+async def test_log_writer_bulk_errors():
+    class FailingCollection:
+        def __init__(self, *errors):
+            self.errors = list(errors)
+            self.written = []
+
+        async def bulk_write(self, batch, ordered):
+            if self.errors:
+                raise BulkWriteError(self.errors.pop(0))
+            self.written += batch
+
+    write_concern = {"writeErrors": [], "writeConcernErrors": [{"code": 64}]}
+    duplicate = {"writeErrors": [{"index": 1, "code": 11000}]}
+    collection = FailingCollection(write_concern, duplicate)
+    writer = LogWriter(collection)
+    writer.queue = [InsertOne({"n": n}) for n in range(3)]
+
+    # Nothing lost when only the write concern failed
+    with pytest.raises(BulkWriteError):
+        await writer.flush()
+    assert writer.depth == 3
+
+    # The culprit is dropped, the writes after it are retried
+    assert await writer.flush() == 1
+    assert await writer.flush() == 1
+    assert [op._doc["n"] for op in collection.written] == [2]
+
+
+@pytest.mark.asyncio
+async def test_dialog_expiry_holds_the_user_lock():
+    class SlowStore(dict):
+        async def load(self, user_id):
+            return self.get(user_id)
+
+        async def save(self, user_id, doc):
+            self[user_id] = doc
+
+        async def delete(self, user_id):
+            await sleep(0.05)
+            self.pop(user_id, None)
+
+    store = SlowStore()
+    manager = DialogManager(store=store, idle_timeout=60)
+    await manager.put(1, Dialog(1, 1, Questionnaire("intro", ["q1"], "outro"), None))
+    # Timed out, just as the user answers
+    manager.wheel.cancel(1)
+
+    async def expiring():
+        async with manager.lock(1):
+            return await manager.expire(1)
+
+    async def answering():
+        await sleep(0.01)
+        async with manager.lock(1):
+            if dialog := await manager.fetch(1):
+                await manager.save(1)
+            return dialog
+
+    expired, answered = await gather(expiring(), answering())
+    # The answer comes after the expiry, rather than bringing the conversation back
+    assert expired and not answered
+    assert 1 not in manager and 1 not in store
+    assert not manager.user_locks and not manager.lock_users
+
+
+@pytest.mark.asyncio
+async def test_coalescer():
+    flushed = []
+
+    async def flush(key, items):
+        flushed.append((key, items))
+
+    coalescer = Coalescer(window=0.1)
+    for n in range(5):
+        await coalescer.submit("chat", n, flush)
+    await coalescer.submit("other", 0, flush)
+    # The first item of each key goes through right away, the next ones when the window closes
+    assert flushed == [("chat", [0]), ("other", [0])]
+    await sleep(0.15)
+    assert flushed[-1] == ("chat", [1, 2, 3, 4])
+
+    # Failures are reported alike on both paths, keys are bounded in number
+    async def failing(key, items):
+        raise RuntimeError("Bot API down")
+
+    bounded = Coalescer(window=60, max_keys=2)
+    for key in range(3):
+        await bounded.submit(key, 0, failing)
+    assert len(bounded.flushed_at) == 2
+
+
+@pytest.mark.asyncio
+async def test_digests_drained_before_shutdown():
+    # PTB shuts the bot down between `post_stop` and `post_shutdown`
+    app = build_app("1:fake")
+    assert (app.post_stop, app.post_shutdown) == (on_stop, on_shutdown)
+
+    flushed = []
+
+    async def flush(key, items):
+        flushed.append(items)
+
+    await notifications.submit("drained", 0, flush)
+    await notifications.submit("drained", 1, flush)
+    await app.post_stop(app)
+    assert flushed == [[0], [1]]
+
+
+@pytest.mark.asyncio
+async def test_failed_sweep_is_rearmed(monkeypatch):
+    async def failing(bot):
+        raise RuntimeError("ADMIN unreachable")
+
+    monkeypatch.setattr(db, "background_task", failing)
+    sweeps = lambda: [d for d in scheduler.heap if d.kind == "sweep"]
+    before = len(sweeps())
+    with pytest.raises(RuntimeError):
+        await db.process_due(None, "sweep", [])
+    assert len(sweeps()) == before + 1
+
+
+@pytest.mark.asyncio
+async def test_lease_expires_in_utc():
+    class Collection:
+        async def find_one_and_update(self, query, update, upsert):
+            self.query, self.update = query, update
+
+    collection = Collection()
+    assert await Lease(collection, "lease", "me", ttl=timedelta(minutes=1)).acquire()
+    expires_at = collection.update["$set"]["expires_at"]
+    assert expires_at.utcoffset() == timedelta(0)
+    assert expires_at - datetime.now(timezone.utc) > timedelta(seconds=59)
+
+
+@pytest.mark.asyncio
+async def test_fetch_due_in_batches(monkeypatch):
+    class Logs:
+        queries = []
+
+        def find(self, query, projection):
+            self.queries.append(query)
+
+            async def docs():
+                for user_id in query["user_id"]["$in"]:
+                    yield {"user_id": user_id, "chat_id": query["chat_id"]}
+
+            return docs()
+
+    monkeypatch.setitem(ctx.__dict__, "logs", Logs())
+    monkeypatch.setattr(db, "DUE_BATCH", 3)
+    among = [User(user_id, chat_id) for chat_id in (1, 2) for user_id in range(7)]
+    due = await db.fetch_due(datetime.now(), notified=False, among=among)
+
+    assert sorted(due) == sorted(among)
+    assert len(Logs.queries) == 6 and all("$or" not in q for q in Logs.queries)
+    assert max(len(q["user_id"]["$in"]) for q in Logs.queries) == 3
+
+
+@pytest.mark.asyncio
+async def test_ordered_processor():
+    # Updates as (chat, user, step), keyed on both
+    processor = OrderedProcessor(
+        limit=2, keys=lambda u: [("chat", u[0]), ("user", u[1])]
+    )
+    done, running, peak = [], 0, 0
+
+    async def process(update):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        # The first updates are the slowest: they would be overtaken if not ordered
+        await sleep(0.05 / update[2])
+        done.append(update)
+        running -= 1
+
+    updates = [(chat, 100 + chat, step) for step in (1, 2, 3) for chat in range(4)]
+    updates.append((0, 103, 4))
+    await gather(*(processor.submit(u, process) for u in updates))
+
+    assert peak == 2
+    for chat in range(4):
+        assert [u[2] for u in done if u[0] == chat] == sorted(
+            u[2] for u in updates if u[0] == chat
+        )
+    # Waits for the updates of both its chat and its user
+    assert done.index((0, 103, 4)) > done.index((3, 103, 3))
+    assert not processor.tails
+
+
+@pytest.mark.asyncio
+async def test_ingress():
+    processed = []
+
+    async def process_update(update):
+        await sleep(0.05)
+        processed.append(update.update_id)
+
+    app = SimpleNamespace(bot=None, process_update=process_update)
+    ingress = Ingress(
+        app, OrderedProcessor(), max_size=2, max_pending=1, secret_token="s"
+    )
+    port = ingress.start(0, "hook/bot1:x")
+    url = f"http://localhost:{port}/hook/bot1:x"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": "s"}
+
+    async with httpx.AsyncClient() as client:
+        post = lambda n, h=headers: client.post(url, json={"update_id": n}, headers=h)
+        assert (await post(0, {})).status_code == 403
+        # One update being processed, two queued, the next one has to come again later
+        codes = [(await post(n)).status_code for n in range(1, 5)]
+        assert codes == [200, 200, 200, 503]
+        await ingress.stop()
+
+    assert processed == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_ingress_flooded_chat():
+    processed = {}
+
+    async def process_update(update):
+        await sleep(0.05)
+        processed[update.update_id] = loop.time()
+
+    loop = get_running_loop()
+    app = SimpleNamespace(bot=None, process_update=process_update)
+    # Update ids stand for chats: 100 and up for the flooded one, 200 for the other
+    processor = OrderedProcessor(keys=lambda update: [update.update_id // 100])
+    ingress = Ingress(app, processor, max_pending=64)
+    port = ingress.start(0, "hook/bot1:x")
+    url = f"http://localhost:{port}/hook/bot1:x"
+
+    async with httpx.AsyncClient() as client:
+        for n in range(100, 120):
+            await client.post(url, json={"update_id": n})
+        posted = loop.time()
+        await client.post(url, json={"update_id": 200})
+        await ingress.stop()
+
+    # The other chat is not held up behind the 20 updates of the flooded one, processed in turn
+    assert processed[200] - posted < 0.3
+    assert list(processed)[-1] == 119 and processed[119] - posted > 0.5
+
+
+@pytest.mark.asyncio
+async def test_dropping_duplicates():
+    update = SimpleNamespace(update_id=-1)
+    await dropping_duplicates(update, None)
+    with pytest.raises(ApplicationHandlerStop):
+        await dropping_duplicates(update, None)
+    await dropping_duplicates(SimpleNamespace(update_id=-2), None)
+
+
 @pytest.mark.asyncio
 async def test_settings():
     chats_ids = await fetch_chat_ids()
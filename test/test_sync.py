@@ -1,18 +1,29 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from os import environ
+from subprocess import run
+from sys import executable
 
 import requests
 from toml import loads
 
+from app.cache import TTLCache
+from app.callbacks import MAX_BYTES, Callback, decode, encode
+from app.db import retention_policy
+from app.handlers import STATUS_PAGE_SIZE, status_page
+from app.metrics import Histogram, registry
+from app.scheduler import EXPIRE_AFTER, REMIND_AFTER, Scheduler
 from app.types import (
     Dialog,
     DialogManager,
     Questionnaire,
     Settings,
     Status,
+    User,
     UserLog,
     UserWithName,
 )
-from app.utils import into_pipeline, slice_on_n
+from app.utils import into_pipeline, iter_slices, slice_on_n, utf16_len
+from app.wheel import TimingWheel
 
 
 def test_settings():
@@ -52,7 +63,7 @@ def test_dialog():
     dial._next_q()
     for _ in dial.questions:
         dial._next_q("answer")
-    assert len(dial.answers) == len(dial.questions)
+    assert dial.answered == len(dial.questions)
 
 
 def test_dialog_manager():
@@ -75,6 +86,52 @@ def test_dialog_manager():
         assert len(conv.questions) == 1
 
 
+def test_timing_wheel():
+    wheel = TimingWheel(tick=1, slots=4, now=0)
+    wheel.schedule("soon", 2)
+    # Further away than a full turn of the wheel
+    wheel.schedule("later", 9)
+    wheel.schedule("cancelled", 1)
+    wheel.cancel("cancelled")
+    wheel.schedule("touched", 2)
+
+    assert wheel.advance(1.5) == []
+    wheel.schedule("touched", 2)
+    assert wheel.advance(2) == ["soon"]
+    assert wheel.advance(3) == ["touched"]
+    assert wheel.advance(8.9) == [] and "later" in wheel
+    assert wheel.advance(9) == ["later"] and len(wheel) == 0
+
+
+def test_dialog_manager_idle_timeout():
+    q = Questionnaire("intro", ["q1"], "outro")
+    manager = DialogManager(idle_timeout=10, wheel=TimingWheel(tick=1, now=0))
+    manager.add(1, Dialog(1, 1, q, None))
+    manager.add(2, Dialog(2, 1, q, None))
+    manager.remove(2)
+
+    assert manager.wheel.advance(10) == [1]
+    manager.add(1, Dialog(1, 1, q, None))
+    assert 1 in manager.wheel
+
+
+def test_dialog_as_dict():
+    q = Questionnaire("intro", ["q1", "q2"], "outro")
+    dialog = Dialog(1, 2, q, None, user_name="user")
+    dialog.take_reply()
+    dialog.take_reply("answer")
+
+    restored = Dialog.from_dict(dialog.as_dict())
+    assert restored.answered == 1 and restored.user_name == "user"
+    assert restored.take_reply("other answer") == "outro"
+    assert restored.done
+
+    # Saved when dialogs held their answers
+    legacy = dialog.as_dict() | {"answers": ["answer"]}
+    del legacy["answered"]
+    assert Dialog.from_dict(legacy).answered == 1
+
+
 def test_questionnaire_from_db():
     d = {
         "questionnaire": {
@@ -105,6 +162,90 @@ def test_status():
     assert len(text) > 0
 
 
+def test_scheduler():
+    now = datetime.now()
+    scheduler = Scheduler()
+    scheduler.register(User(1, 1), now)
+    scheduler.register(User(2, 1), now - REMIND_AFTER)
+    assert len(scheduler) == 4
+
+    due = scheduler.pop_due(now)
+    assert due == {"remind": [User(2, 1)]}
+    assert scheduler.pop_due(now + timedelta(seconds=1)) == {}
+
+    due = scheduler.pop_due(now + EXPIRE_AFTER)
+    assert due == {"remind": [User(1, 1)], "expire": [User(2, 1), User(1, 1)]}
+    assert len(scheduler) == 0
+
+
+def test_ttl_cache():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.put(1, "a")
+    cache.put(2, "b")
+    assert cache.fetch(1) == "a"
+
+    # 2 is now the least recently used entry
+    cache.put(3, "c")
+    assert cache.fetch(2) is None
+    assert cache.fetch(3) == "c"
+
+    cache.invalidate(3)
+    assert cache.fetch(3) is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    expired = TTLCache(ttl=0)
+    expired.put(1, "a")
+    assert expired.fetch(1) is None and len(expired) == 0
+
+    # As set up with several workers
+    disabled = TTLCache(max_size=0)
+    disabled.put(1, "a")
+    assert disabled.fetch(1) is None and len(disabled) == 0
+
+
+def test_retention_policy():
+    default = retention_policy("")
+    assert "background_task" not in default and default["wants_to_join"] == 30
+
+    policy = retention_policy("wants_to_join=7, background_task=90,is_banned=off")
+    assert policy["wants_to_join"] == 7 and policy["background_task"] == 90
+    assert "is_banned" not in policy
+
+
+def test_histogram():
+    h = Histogram("test_latency_seconds", "Test", buckets=(0.1, 1))
+    registry.remove(h)
+    for value in (0.05, 0.5, 0.5, 3):
+        h.observe(value, handler="x")
+    lines = h.render().splitlines()
+    assert 'test_latency_seconds_bucket{handler="x",le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{handler="x",le="1"} 3' in lines
+    assert 'test_latency_seconds_bucket{handler="x",le="+Inf"} 4' in lines
+    assert 'test_latency_seconds_count{handler="x"} 4' in lines
+
+
+def test_callback_data():
+    digest_id = "64b7f0c2a1b2c3d4e5f60718"
+    assert decode(encode("digest-page", digest_id, 3)) == Callback(
+        "digest-page", (digest_id, 3)
+    )
+    assert decode(encode("self-confirm", 123, -1001234567890)) == Callback(
+        "self-confirm", (123, -1001234567890)
+    )
+
+    # Display names are cut to fit, on a character boundary
+    data = encode("accept", -1001234567890, 5234567890, text="\U0001F600" * 40)
+    assert len(data.encode()) <= MAX_BYTES
+    callback = decode(data)
+    assert callback.args == (-1001234567890, 5234567890)
+    assert callback.text and set(callback.text) == {"\U0001F600"}
+
+    # Buttons sent before versioning
+    legacy = decode("accept§-100123§https://t.me/chat§42§john")
+    assert legacy == Callback("accept", (-100123, 42), "john")
+    assert decode("garbage") is None and decode("1!!") is None
+
+
 def test_into_pipeline():
     producer = [1, 2, 3, 4]
     fi = lambda x: x if x % 2 == 0 else None
@@ -125,3 +266,53 @@ def test_slice_on_4096():
     assert len(sample) - summed_partitions <= 3
 
     print("\n8<-------------\n".join(sliced))
+
+
+def test_slices_utf16():
+    # Line breaks are preferred, and dropped
+    assert slice_on_n("abc\ndef", n=5) == ["abc", "def"]
+
+    # Emojis count as two UTF-16 code units
+    sample = ("\U0001F600" * 3 + "abc\n") * 50_000
+    slices = list(iter_slices(sample, 4096))
+    assert all(utf16_len(s) <= 4096 for s in slices)
+    assert sum(len(s) for s in slices) + len(slices) - 1 >= len(sample) - 1
+
+    # Without any line break, as long as it takes
+    assert "".join(slice_on_n("x" * 100_000, n=7)) == "x" * 100_000
+
+    # Windows too small for an emoji
+    assert slice_on_n("\U0001F600" * 3, n=1) == ["\U0001F600"] * 3
+
+
+def test_status_page():
+    pages = slice_on_n("line\n" * 3000, n=STATUS_PAGE_SIZE)
+    text, has_next = status_page(pages, 0)
+    assert text.startswith("(1/4) ") and has_next
+    text, has_next = status_page(pages, 3)
+    assert text.startswith("(4/4) ") and not has_next
+    assert status_page(pages, 4) is None
+
+
+def test_render():
+    at = datetime(2023, 5, 1, 12, 0)
+    users = [UserWithName(i, f"user_{i}", at) for i in range(2)]
+    status = Status(-100, users, [], [], "summary")
+    assert status.render() == (
+        "\nchat_id: -100\npending: \nuser_name: user_0\nat: 2023-05-01 12:00:00, "
+        + "\nuser_id: 1\nuser_name: user_1\nat: 2023-05-01 12:00:00\n\nwork_summary: summary"
+    )
+
+    settings = Settings({"mode": "auto", "chat_url": "https://t.me/x_y"}, -100)
+    assert settings.render() == (
+        "mode: auto\nchat\\_url: https://t.me/x\\_y\nchat\\_id: -100\n"
+    )
+
+
+def test_lazy_imports():
+    # Types and helpers are usable without a database, nothing being connected nor read on import
+    env = {k: v for k, v in environ.items() if k != "MONGO_CONN_STRING"}
+    code = "import sys, app.types, app.utils; print(sorted({'motor', 'toml'} & set(sys.modules)))"
+    result = run([executable, "-c", code], env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "[]"